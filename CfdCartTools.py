@@ -41,6 +41,10 @@ import math
 import MeshPart
 import TemplateBuilder
 
+# Format of mesh region surface files: "binary" or "ascii". The part geometry is always written as ascii, since its
+# solid names become the patch names.
+REGION_STL_FORMAT = "binary"
+
 class CfdCartTools():
     def __init__(self, cart_mesh_obj, analysis=None):
         self.mesh_obj = cart_mesh_obj
@@ -152,6 +156,18 @@ class CfdCartTools():
 
         from collections import defaultdict
         self.ele_meshpatch_map = defaultdict(list)
+        # Part faces matching each boundary layer region face, from the mesh object's mapping cache
+        layer_refs = []
+        if self.mesh_obj.MeshUtility == 'cfMesh':
+            layer_refs = [(sub[0], elems) for mr_obj in self.mesh_obj.MeshRegionList
+                          if mr_obj.RelativeLength and mr_obj.NumberLayers > 1
+                          for sub in mr_obj.References for elems in sub[1]
+                          if sub[0].Shape.getElement(elems).ShapeType == 'Face']
+        layer_faces = {}
+        if layer_refs:
+            matches, face_mapping = CfdTools.matchShapeFaces(self.mesh_obj, layer_refs)
+            CfdTools.storeFaceMapping(self.mesh_obj, face_mapping)
+            layer_faces = dict(zip([(o.Name, e) for o, e in layer_refs], matches))
         if not self.mesh_obj.MeshRegionList:
             print ('  No mesh regions.')
         else:
@@ -174,7 +190,7 @@ class CfdCartTools():
                             "The meshregion: {} should not use a relative length smaller "
                             "than 0.05.\n".format(mr_obj.Name))
 
-                    tri_surface = ""
+                    region_solids = []
                     snappy_mesh_region_list = []
                     patch_list = []
                     for (si, sub) in enumerate(mr_obj.References):
@@ -186,52 +202,39 @@ class CfdCartTools():
                                 facemesh = MeshPart.meshFromShape(elt,
                                                                   LinearDeflection=self.mesh_obj.STLLinearDeflection)
 
-                                tri_surface += "solid {}{}{}\n".format(mr_obj.Name, sub[0].Name, elems)
-                                for face in facemesh.Facets:
-                                    tri_surface += " facet normal 0 0 0\n"
-                                    tri_surface += "  outer loop\n"
-                                    for i in range(3):
-                                        p = [i * self.scale for i in face.Points[i]]
-                                        tri_surface += "    vertex {} {} {}\n".format(p[0], p[1], p[2])
-                                    tri_surface += "  endloop\n"
-                                    tri_surface += " endfacet\n"
-                                tri_surface += "solid {}{}{}\n".format(mr_obj.Name, sub[0].Name, elems)
+                                region_solids.append(("{}{}{}".format(mr_obj.Name, sub[0].Name, elems),
+                                                      CfdTools.meshTriangles(facemesh)))
 
                                 if self.mesh_obj.MeshUtility == 'snappyHexMesh' and mr_obj.Baffle:
                                     # Save baffle references or faces individually
                                     baffle = "{}{}{}".format(mr_obj.Name, sub[0].Name, elems)
-                                    fid = open(os.path.join(self.triSurfaceDir, baffle + ".stl"), 'w')
-                                    fid.write(tri_surface)
-                                    fid.close()
-                                    tri_surface = ""
+                                    CfdTools.writeSTL(os.path.join(self.triSurfaceDir, baffle + ".stl"),
+                                                      region_solids, self.scale, REGION_STL_FORMAT == "binary")
+                                    region_solids = []
                                     snappy_mesh_region_list.append(baffle)
                                 elif self.mesh_obj.MeshUtility == 'cfMesh' and mr_obj.NumberLayers > 1:
                                     # Similarity search for patch used in boundary layer meshing
-                                    meshFaceList = self.mesh_obj.Part.Shape.Faces
-                                    for (i, mf) in enumerate(meshFaceList):
-                                        isSameGeo = CfdTools.isSameGeometry(elt, mf)
-                                        if isSameGeo and (mr_obj.NumberLayers > 1):  # Only one matching face
-                                            sfN = self.mesh_obj.ShapeFaceNames[i]
-                                            self.ele_meshpatch_map[mr_obj.Name].append(sfN)
-                                            patch_list.append(self.mesh_obj.ShapeFaceNames[i])
-
-                                            # Limit expansion ratio to greater than 1.0 and less than 1.2
-                                            expratio = mr_obj.ExpansionRatio
-                                            expratio = min(1.2, max(1.0, expratio))
-
-                                            cf_settings['BoundaryLayers'][self.mesh_obj.ShapeFaceNames[i]] = {
-                                                'NumberLayers': mr_obj.NumberLayers,
-                                                'ExpansionRatio': expratio,
-                                                'FirstLayerHeight': self.scale *
-                                                                    Units.Quantity(mr_obj.FirstLayerHeight).Value
-                                            }
+                                    for i in layer_faces[(sub[0].Name, elems)]:
+                                        sfN = self.mesh_obj.ShapeFaceNames[i]
+                                        self.ele_meshpatch_map[mr_obj.Name].append(sfN)
+                                        patch_list.append(self.mesh_obj.ShapeFaceNames[i])
+
+                                        # Limit expansion ratio to greater than 1.0 and less than 1.2
+                                        expratio = mr_obj.ExpansionRatio
+                                        expratio = min(1.2, max(1.0, expratio))
+
+                                        cf_settings['BoundaryLayers'][self.mesh_obj.ShapeFaceNames[i]] = {
+                                            'NumberLayers': mr_obj.NumberLayers,
+                                            'ExpansionRatio': expratio,
+                                            'FirstLayerHeight': self.scale *
+                                                                Units.Quantity(mr_obj.FirstLayerHeight).Value
+                                        }
                             else:
                                 FreeCAD.Console.PrintError("Cartesian meshes only support surface refinement.\n")
 
                     if self.mesh_obj.MeshUtility == 'cfMesh' or not mr_obj.Baffle:
-                        fid = open(os.path.join(self.triSurfaceDir, mr_obj.Name + '.stl'), 'w')
-                        fid.write(tri_surface)
-                        fid.close()
+                        CfdTools.writeSTL(os.path.join(self.triSurfaceDir, mr_obj.Name + '.stl'),
+                                          region_solids, self.scale, REGION_STL_FORMAT == "binary")
 
                     if self.mesh_obj.MeshUtility == 'cfMesh':
                         cf_settings['MeshRegions'][mr_obj.Label] = {
@@ -291,25 +294,13 @@ class CfdCartTools():
         if ("Boolean" in self.part_obj.Name) and self.mesh_obj.MeshUtility:
             FreeCAD.Console.PrintError('cfMesh and snappyHexMesh do not accept boolean segments.')
 
-        fullMeshFile = open(self.temp_file_geo+'.stl', 'w')
+        solids = []
         for (i, objFaces) in enumerate(self.part_obj.Shape.Faces):
             faceName = ("face{}".format(i))
             mesh_stl = MeshPart.meshFromShape(objFaces, LinearDeflection = self.mesh_obj.STLLinearDeflection)
-            fullMeshFile.write("solid {}\n".format(faceName))
-            for face in mesh_stl.Facets:
-                n = face.Normal
-                fullMeshFile.write(" facet normal {} {} {}\n".format(n[0], n[1], n[2]))
-                fullMeshFile.write("  outer loop\n")
-                for j in range(3):
-                    p = face.Points[j]
-                    fullMeshFile.write("    vertex {} {} {}".format(self.scale*p[0],
-                                                                    self.scale*p[1],
-                                                                    self.scale*p[2]))
-                    fullMeshFile.write("\n")
-                fullMeshFile.write("  endloop\n")
-                fullMeshFile.write(" endfacet\n")
-            fullMeshFile.write("endsolid {}\n".format(faceName))
-        fullMeshFile.close()
+            solids.append((faceName, CfdTools.meshTriangles(mesh_stl)))
+        # The solid names are the face names used as patch names, which binary STL cannot hold
+        CfdTools.writeSTL(self.temp_file_geo+'.stl', solids, self.scale)
 
     def read_and_set_new_mesh(self):
         if not self.error:
@@ -329,8 +320,10 @@ class CfdCartTools():
         else:
             print('No mesh was created.')
 
-    def write_mesh_case(self):
-        """ Write_case() will collect case setings, and finally build a runnable case. """
+    def write_mesh_case(self, output=None):
+        """ Write_case() will collect case setings, and finally build a runnable case. If an output backend for
+        TemplateBuilder is given (e.g. TemplateBuilder.MemoryOutput), the mesh case files are rendered into it
+        instead of the mesh case directory. """
         tmpdir = tempfile.gettempdir()
         FreeCAD.Console.PrintMessage("Populating mesh dictionaries in folder {}\n".format(tmpdir))
         _cwd = os.curdir
@@ -414,13 +407,15 @@ class CfdCartTools():
                 'SnappySettings': self.snappy_settings
             }
 
-            TemplateBuilder.TemplateBuilder(self.meshCaseDir, self.template_path, self.settings)
+            TemplateBuilder.TemplateBuilder(self.meshCaseDir, self.template_path, self.settings, output=output,
+                                            cache_dir=CfdTools.getCacheDir("templates"))
 
-            # Update Allmesh permission - will fail silently on Windows
-            fname = os.path.join(self.meshCaseDir, "Allmesh")
-            import stat
-            s = os.stat(fname)
-            os.chmod(fname, s.st_mode | stat.S_IEXEC)
+            if output is None:
+                # Update Allmesh permission - will fail silently on Windows
+                fname = os.path.join(self.meshCaseDir, "Allmesh")
+                import stat
+                s = os.stat(fname)
+                os.chmod(fname, s.st_mode | stat.S_IEXEC)
 
         except:
             raise
@@ -43,18 +43,40 @@ import Units
 import TemplateBuilder
 
 
+# Identifies the source of the mesh last written to the case, to allow skipping unchanged meshes when updating
+MESH_SIGNATURE_FILE = ".meshSignature"
+# The mesh is cloned from the meshing case rather than hard-linked, since it must be left intact for later case
+# writes while the case's copy may be rewritten in place by OpenFOAM utilities
+MESH_TRANSFER_MODE = "reflink"
+# How gmsh meshes are converted: "polyMesh" to write them directly, or "unv" to export a UNV file and convert it with
+# the OpenFOAM utilities
+GMSH_MESH_CONVERSION = "polyMesh"
+# Format of directly written polyMesh files: "ascii" or "binary"
+POLYMESH_FORMAT = "ascii"
+# Report of template rendering statistics when profiling is enabled
+PROFILE_FILE = "templateProfile.json"
+
+
 # Write CFD analysis setup into OpenFOAM case
 # write_case() is the only public API
 # Derived from QRunnable in order to run in a worker thread
 # NB: Don't use Console.PrintMessage or any GUI functions here, since running in a worker thread
 
+def isLaterTime(name):
+    """ Whether name is that of a time directory after the initial one """
+    try:
+        return float(name) > 0
+    except ValueError:
+        return False
+
+
 class CfdCaseWriterSignals(QObject):
     error = QtCore.Signal(str)  # Signal in PySide, pyqtSignal in PyQt
     finished = QtCore.Signal(bool)
 
 
 class CfdCaseWriterFoam(QRunnable):
-    def __init__(self, analysis_obj):
+    def __init__(self, analysis_obj, updating=False, profile=False):
         super(CfdCaseWriterFoam, self).__init__()
 
         self.analysis_obj = analysis_obj
@@ -68,27 +90,40 @@ class CfdCaseWriterFoam(QRunnable):
         self.initialisationZone_objs = CfdTools.getInitialisationZoneObjects(analysis_obj)
         self.zone_objs = CfdTools.getZoneObjects(analysis_obj)
         self.mesh_generated = False
+        self.updating = updating  # Update an existing case incrementally when run in a worker thread
+        self.profile = profile  # Report the time taken to render each case file
+        self.fsync = False  # Flush the new case to disk before it replaces the old one
+        self.face_mapping = None  # Face mapping of the Cartesian mesh still to be saved by storeFaceMapping
 
         self.signals = CfdCaseWriterSignals()
 
     def run(self):
         success = False
         try:
-            success = self.write_case()
+            success = self.write_case(self.updating)
         except Exception as e:
             self.signals.error.emit(str(e))
             self.signals.finished.emit(False)
             raise
         self.signals.finished.emit(success)
 
-    def write_case(self, updating=False):
-        """ Write_case() will collect case setings, and finally build a runnable case. """
+    def write_case(self, updating=False, output=None):
+        """ Write_case() will collect case setings, and finally build a runnable case. If updating, an existing case
+        is updated in place rather than being cleared: only files whose contents have changed are rewritten, files
+        no longer produced and the results of previous runs are removed, and the mesh is only written again if it has
+        changed.
+        If an output backend for TemplateBuilder is given (e.g. TemplateBuilder.MemoryOutput), the case files are
+        rendered into it instead, and the case folder, mesh and surface files are not touched.
+        Otherwise, unless updating a case previously written by this writer, the case is written to a staging folder
+        which only replaces the case folder once it is complete, so that an interrupted write never leaves a
+        partially written case. """
         print("Start to write case to folder {}\n".format(self.solver_obj.WorkingDir))
         _cwd = os.curdir
         if not os.path.exists(self.solver_obj.WorkingDir):
             raise IOError("Path " + self.solver_obj.WorkingDir + " does not exist.")
         os.chdir(self.solver_obj.WorkingDir)  # pyFoam can not write to cwd if FreeCAD is started NOT from terminal
 
+        staged = False
         try:  # Make sure we restore cwd after exception here
             # Perform initialisation here rather than __init__ in case of path changes
             self.case_folder = os.path.join(self.solver_obj.WorkingDir, self.solver_obj.InputCaseName)
@@ -124,9 +159,17 @@ class CfdCaseWriterFoam(QRunnable):
             self.processFluidProperties()
             self.processBoundaryConditions()
             self.processInitialConditions()
-            self.clearCase()
-
-            self.exportZoneStlSurfaces()
+            if updating and output is None:
+                if os.path.isfile(os.path.join(self.case_folder, TemplateBuilder.MANIFEST_FILE)):
+                    self.clearResults()
+                else:
+                    # No case previously written by this writer to update
+                    updating = False
+            staged = output is None and not updating
+            if staged:
+                self.stageCase()
+            if output is None:
+                self.exportZoneStlSurfaces()
             if self.porousZone_objs:
                 self.processPorousZoneProperties()
             self.processInitialisationZoneProperties()
@@ -135,26 +178,58 @@ class CfdCaseWriterFoam(QRunnable):
             if self.mesh_obj.Proxy.Type == "CfdMeshCart":  # Cut-cell Cartesian
                 self.setupPatchNames()
 
-            TemplateBuilder.TemplateBuilder(self.case_folder, self.template_path, self.settings)
-            self.writeMesh()
+            builder = TemplateBuilder.TemplateBuilder(self.case_folder, self.template_path, self.settings,
+                                                      incremental=updating, profile=self.profile, output=output,
+                                                      cache_dir=CfdTools.getCacheDir("templates"))
+            if updating:
+                FreeCAD.Console.PrintMessage("{} of {} case files unaffected by changes\n".format(
+                    len(builder.skipped_templates), len(builder.sources)))
+
+            if output is None:
+                mesh_written = self.writeMesh(updating)
+
+                # Update Allrun permission - will fail silently on Windows
+                fname = os.path.join(self.case_folder, "Allrun")
+                import stat
+                s = os.stat(fname)
+                os.chmod(fname, s.st_mode | stat.S_IEXEC)
 
-            # Update Allrun permission - will fail silently on Windows
-            fname = os.path.join(self.case_folder, "Allrun")
-            import stat
-            s = os.stat(fname)
-            os.chmod(fname, s.st_mode | stat.S_IEXEC)
+                if mesh_written:
+                    # Move mesh files, after being edited, to polyMesh.org
+                    CfdTools.movePolyMesh(self.case_folder)
+                    self.writeMeshSignature()
 
-            # Move mesh files, after being edited, to polyMesh.org
-            CfdTools.movePolyMesh(self.case_folder)
+            if staged:
+                self.commitCase()
 
         except:
             raise
         finally:
+            if staged and self.case_folder != self.final_case_folder:
+                # Leave the existing case untouched
+                shutil.rmtree(self.case_folder, ignore_errors=True)
+                self.case_folder = self.final_case_folder
             os.chdir(_cwd)  # Restore working dir
         print("Successfully wrote {} case to folder {}\n".format(
               self.solver_obj.SolverName, self.solver_obj.WorkingDir))
+        if self.profile:
+            if output is None:
+                profile_file = os.path.join(self.case_folder, PROFILE_FILE)
+                builder.writeProfileReport(profile_file)
+                print("Case file rendering profile (also written to {}):\n".format(profile_file))
+            else:
+                print("Case file rendering profile:\n")
+            print(builder.profileTable())
+        if CfdTools.isMainThread():
+            self.storeFaceMapping()
         return True
 
+    def storeFaceMapping(self):
+        """ Save the face mapping found while writing the case in the mesh object. Document properties may only be
+        changed on the main thread, so when the case is written in a worker thread this is left to the caller. """
+        CfdTools.storeFaceMapping(self.mesh_obj, self.face_mapping)
+        self.face_mapping = None
+
     def getSolverName(self):
         """ Solver name is selected based on selected physics. This should only be extended as additional physics are
         included. """
@@ -194,39 +269,80 @@ class CfdCaseWriterFoam(QRunnable):
         system_settings['FoamPath'] = CfdTools.getFoamDir()
         system_settings['TranslatedFoamPath'] = CfdTools.translatePath(CfdTools.getFoamDir())
 
-    def clearCase(self, backup_path=None):
-        """ Remove and recreate case directory, optionally backing up """
-        output_path = self.case_folder
-        if backup_path and os.path.isdir(output_path):
-            shutil.move(output_path, backup_path)
-        if os.path.isdir(output_path):
-            shutil.rmtree(output_path)
-        os.makedirs(output_path)  # mkdir -p
+    def stageCase(self):
+        """ Redirect writing of the case to an empty staging folder next to the case folder, which replaces it when
+        committed. Settings referring to the case folder must already have been processed. """
+        self.final_case_folder = self.case_folder
+        self.case_folder = CfdTools.makeStagingDir(self.case_folder)
+
+    def commitCase(self, backup_path=None):
+        """ Replace the case folder with the staged one, optionally backing up the old case """
+        staging_folder = self.case_folder
+        self.case_folder = self.final_case_folder
+        CfdTools.commitStagingDir(staging_folder, self.case_folder, backup_path, fsync=self.fsync)
+
+    def clearResults(self):
+        """ Remove the results of previous runs from a case being updated, so that it is left as if newly written:
+        the time directories other than the initial one, and the decomposed case """
+        for item in os.listdir(self.case_folder):
+            path = os.path.join(self.case_folder, item)
+            if os.path.isdir(path) and (item.startswith('processor') or isLaterTime(item)):
+                shutil.rmtree(path)
 
     # Mesh
 
-    def writeMesh(self):
-        """ Convert or copy mesh files """
-        if self.mesh_obj.Proxy.Type == "FemMeshGmsh":  # GMSH
+    def writeMesh(self, updating=False):
+        """ Convert or copy mesh files. If updating, this is skipped if the mesh is unchanged since it was last
+        written. Returns whether the mesh was written. """
+        if self.mesh_obj.Proxy.Type == "FemMeshGmsh" and GMSH_MESH_CONVERSION == "polyMesh":
+            print("Writing GMSH")
+            source = CfdTools.getPolyMeshSource(self.mesh_obj, self.bc_group)
+            # FreeCAD always stores the CAD geometry in mm, while FOAM by default uses SI units. This is independent
+            # of the user selected unit preferences.
+            scale = 0.001
+            self.mesh_signature = CfdTools.hashPolyMeshSource(source, scale, POLYMESH_FORMAT)
+            if updating and self.meshUnchanged():
+                print("Mesh unchanged\n")
+                return False
+            mesh_cache = CfdTools.MeshCache()
+            key = mesh_cache.key(self.mesh_signature, CfdTools.POLYMESH_WRITER_VERSION)
+            mesh_dir = os.path.join(self.case_folder, 'constant', 'polyMesh')
+            if mesh_cache.fetch(key, mesh_dir):
+                print("Using previously written mesh\n")
+            else:
+                CfdTools.write_polymesh(source, mesh_dir, scale, binary=(POLYMESH_FORMAT == "binary"))
+                mesh_cache.store(key, mesh_dir)
+        elif self.mesh_obj.Proxy.Type == "FemMeshGmsh":  # GMSH
             # Convert GMSH created UNV file to OpenFoam
             print("Writing GMSH")
             unvMeshFile = self.case_folder + os.path.sep + self.solver_obj.InputCaseName + u".unv"
             self.mesh_generated = CfdTools.write_unv_mesh(self.mesh_obj, self.bc_group, unvMeshFile)
+            # Patch types are set from changeDictionaryDict during conversion
+            self.mesh_signature = CfdTools.hashFiles(
+                [unvMeshFile, os.path.join(self.case_folder, 'system', 'changeDictionaryDict')])
+            if updating and self.meshUnchanged():
+                print("Mesh unchanged\n")
+                return False
             # FreeCAD always stores the CAD geometry in mm, while FOAM by default uses SI units. This is independent
             # of the user selected unit preferences.
             self.setupMesh(unvMeshFile, scale = 0.001)
         elif self.mesh_obj.Proxy.Type == "CfdMeshCart":  # Cut-cell Cartesian
             import CfdCartTools
+            self.cart_mesh = CfdCartTools.CfdCartTools(self.mesh_obj)
+            cart_mesh = self.cart_mesh
+            cart_mesh.get_tmp_file_paths()  # Update tmp file locations
+            # The meshing utility rewrites these whenever it is run, so their stats identify the mesh
+            self.mesh_signature = CfdTools.hashFileStats([cart_mesh.polyMeshDir, cart_mesh.triSurfaceDir])
+            if updating and self.meshUnchanged():
+                print("Mesh unchanged\n")
+                return False
             ## Move Cartesian mesh files from temporary mesh directory to case directory
             if self.mesh_obj.MeshUtility == "cfMesh":
                 print("Writing Cartesian mesh\n")
-                #import CfdCartTools
-                self.cart_mesh = CfdCartTools.CfdCartTools(self.mesh_obj)
-                cart_mesh = self.cart_mesh
-                # cart_mesh.get_tmp_file_paths("cfMesh")  # Update tmp file locations
-                cart_mesh.get_tmp_file_paths()  # Update tmp file locations
-                CfdTools.copyFilesRec(cart_mesh.polyMeshDir, os.path.join(self.case_folder, 'constant', 'polyMesh'))
-                CfdTools.copyFilesRec(cart_mesh.triSurfaceDir, os.path.join(self.case_folder, 'constant', 'triSurface'))
+                CfdTools.transferPolyMesh(cart_mesh.polyMeshDir, os.path.join(self.case_folder, 'constant', 'polyMesh'),
+                                          mode=MESH_TRANSFER_MODE)
+                CfdTools.copyFilesRec(cart_mesh.triSurfaceDir, os.path.join(self.case_folder, 'constant', 'triSurface'),
+                                      mode=MESH_TRANSFER_MODE)
                 # shutil.copy2(cart_mesh.temp_file_meshDict, os.path.join(self.case_folder,'system'))
                 shutil.copy2(os.path.join(cart_mesh.meshCaseDir, 'system', 'meshDict'),
                              os.path.join(self.case_folder,'system'))
@@ -236,12 +352,10 @@ class CfdCaseWriterFoam(QRunnable):
 
             elif self.mesh_obj.MeshUtility == "snappyHexMesh":
                 print("Writing snappyHexMesh generated Cartesian mesh\n")
-                self.cart_mesh = CfdCartTools.CfdCartTools(self.mesh_obj)
-                cart_mesh = self.cart_mesh
-                # cart_mesh.get_tmp_file_paths("snappyHexMesh")  # Update tmp file locations
-                cart_mesh.get_tmp_file_paths()  # Update tmp file locations
-                CfdTools.copyFilesRec(cart_mesh.polyMeshDir, os.path.join(self.case_folder,'constant','polyMesh'))
-                CfdTools.copyFilesRec(cart_mesh.triSurfaceDir, os.path.join(self.case_folder,'constant','triSurface'))
+                CfdTools.transferPolyMesh(cart_mesh.polyMeshDir, os.path.join(self.case_folder, 'constant', 'polyMesh'),
+                                          mode=MESH_TRANSFER_MODE)
+                CfdTools.copyFilesRec(cart_mesh.triSurfaceDir, os.path.join(self.case_folder,'constant','triSurface'),
+                                      mode=MESH_TRANSFER_MODE)
                 # shutil.copy2(cart_mesh.temp_file_blockMeshDict, os.path.join(self.case_folder,'system'))
                 # shutil.copy2(cart_mesh.temp_file_snappyMeshDict, os.path.join(self.case_folder,'system'))
                 # shutil.copy2(cart_mesh.temp_file_surfaceFeatureExtractDict, os.path.join(self.case_folder,'system'))
@@ -257,10 +371,38 @@ class CfdCaseWriterFoam(QRunnable):
                 shutil.copy2(os.path.join(cart_mesh.meshCaseDir, 'log.snappyHexMesh'), self.case_folder)
         else:
             raise RuntimeError("Unrecognised mesh type")
+        return True
+
+    def meshUnchanged(self):
+        """ Whether the mesh in the case was written from the same source as the current one, and has not been used
+        since. Once Allrun has been run, constant/polyMesh links into polyMesh.org, and utilities such as createPatch
+        may have modified the mesh through the links. """
+        try:
+            with open(os.path.join(self.case_folder, MESH_SIGNATURE_FILE)) as f:
+                signature = f.read().strip()
+        except IOError:
+            return False
+        return signature == self.mesh_signature and \
+            os.path.isdir(os.path.join(self.case_folder, "constant", "polyMesh.org")) and \
+            not os.path.lexists(os.path.join(self.case_folder, "constant", "polyMesh"))
+
+    def writeMeshSignature(self):
+        with open(os.path.join(self.case_folder, MESH_SIGNATURE_FILE), 'w') as f:
+            f.write(self.mesh_signature + "\n")
 
     def setupMesh(self, updated_mesh_path, scale):
         if os.path.exists(updated_mesh_path):
-            CfdTools.convertMesh(self.case_folder, updated_mesh_path, scale)
+            # The mesh signature covers the UNV file and the boundary patch types, which are all that the conversion
+            # depends on apart from the scale and OpenFOAM version
+            mesh_cache = CfdTools.MeshCache()
+            key = mesh_cache.key(self.mesh_signature, scale, CfdTools.getFoamDir())
+            mesh_dir = os.path.join(self.case_folder, 'constant', 'polyMesh')
+            if mesh_cache.fetch(key, mesh_dir):
+                print("Using previously converted mesh\n")
+            else:
+                CfdTools.removePolyMesh(mesh_dir)
+                CfdTools.convertMesh(self.case_folder, updated_mesh_path, scale)
+                mesh_cache.store(key, mesh_dir)
 
     def processFluidProperties(self):
         # self.material_obj stores everything as a string for compatibility with FreeCAD material objects.
@@ -412,10 +554,7 @@ class CfdCaseWriterFoam(QRunnable):
             import Mesh
             for i in range(len(zo.partNameList)):
                 #shape = zo.shapeList[i].Shape
-                path = os.path.join(self.solver_obj.WorkingDir,
-                                    self.solver_obj.InputCaseName,
-                                    "constant",
-                                    "triSurface")
+                path = os.path.join(self.case_folder, "constant", "triSurface")
                 if not os.path.exists(path):
                     os.makedirs(path)
                 fname = os.path.join(path, zo.partNameList[i]+u".stl")
@@ -510,20 +649,23 @@ class CfdCaseWriterFoam(QRunnable):
         bc_group = self.bc_group
         mobj = self.mesh_obj
         bc_allocated = []
+        # Match all references at once so that the mapping cache is only checked and updated once
+        references = [(FreeCAD.ActiveDocument.getObject(br[0]), br[1]) for bc_obj in bc_group
+                      for br in bc_obj.References]
+        ref_matches, self.face_mapping = CfdTools.matchShapeFaces(mobj, references)
+        ref_matches = iter(ref_matches)
         for bc_id, bc_obj in enumerate(bc_group):
             bc_list = []
-            meshFaceList = mobj.Part.Shape.Faces
-            for (i, mf) in enumerate(meshFaceList):
-                bc_refs = bc_obj.References
-                for br in bc_refs:
-                    bf = FreeCAD.ActiveDocument.getObject(br[0]).Shape.getElement(br[1])
-                    isSameGeo = CfdTools.isSameGeometry(bf, mf)
-                    if isSameGeo:
-                        bc_list.append(mobj.ShapeFaceNames[i])
-                        if mobj.ShapeFaceNames[i] in bc_allocated:
-                            print ('Error: {} has been assigned twice'.format(mobj.ShapeFaceNames[i]))
-                        else:
-                            bc_allocated.append(mobj.ShapeFaceNames[i])
+            # Mesh face indices matching each reference, listed in face order
+            matches = []
+            for br in bc_obj.References:
+                matches += next(ref_matches)
+            for i in sorted(matches):
+                bc_list.append(mobj.ShapeFaceNames[i])
+                if mobj.ShapeFaceNames[i] in bc_allocated:
+                    print ('Error: {} has been assigned twice'.format(mobj.ShapeFaceNames[i]))
+                else:
+                    bc_allocated.append(mobj.ShapeFaceNames[i])
 
             bcDict = bc_obj.BoundarySettings
             bcType = bcDict["BoundaryType"]
@@ -567,6 +709,7 @@ class CfdCaseWriterFoam(QRunnable):
                 if bcType == "baffle":
                     tempBaffleList = []
                     tempBaffleListSlave = []
+                    bc_face_index = CfdTools.FaceIndex(bc_obj.Shape.Faces)
                     if self.mesh_obj.MeshRegionList:  # Can this if statement not be lumped with previous?
                         for regionObj in self.mesh_obj.MeshRegionList:
                             # print regionObj.Name
@@ -576,12 +719,9 @@ class CfdCaseWriterFoam(QRunnable):
                                     for elems in sub[1]:
                                         elt = sub[0].Shape.getElement(elems)
                                         if elt.ShapeType == 'Face':
-                                            bcFacesList = bc_obj.Shape.Faces
-                                            for bf in bcFacesList:
-                                                isSameGeo = CfdTools.isSameGeometry(bf, elt)
-                                                if isSameGeo:
-                                                    tempBaffleList.append(regionObj.Name+sub[0].Name+elems)
-                                                    tempBaffleListSlave.append(regionObj.Name+sub[0].Name+elems+"_slave")
+                                            for bf in bc_face_index.find(elt):
+                                                tempBaffleList.append(regionObj.Name+sub[0].Name+elems)
+                                                tempBaffleListSlave.append(regionObj.Name+sub[0].Name+elems+"_slave")
                     settings['createPatchesSnappyBaffles'][bc_obj.Label] = {"PatchNamesList" : tuple(tempBaffleList),
                                                                             "PatchNamesListSlave" : tuple(tempBaffleListSlave)}
 
@@ -41,7 +41,6 @@ import CfdConsoleProcess
 
 if FreeCAD.GuiUp:
     import FreeCADGui
-    import FemGui
     from PySide import QtCore
     from PySide import QtGui
     from PySide.QtCore import Qt, QRunnable, QObject, QThread
@@ -98,6 +97,7 @@ class CfdPreferencePage:
 
     def saveSettings(self):
         CfdTools.setFoamDir(self.foam_dir)
+        CfdTools.refreshFoamDiscovery()
 
     def loadSettings(self):
         # Don't set the autodetected location, since the user might want to allow that to vary according
@@ -123,6 +123,8 @@ class CfdPreferencePage:
         self.form.le_foam_dir.setText(self.foam_dir)
 
     def runDependencyChecker(self):
+        # Pick up any installation changes since the last check
+        CfdTools.refreshFoamDiscovery()
         self.thread.task = DEPENDENCY_CHECK
         self.startThread()
         QApplication.setOverrideCursor(Qt.WaitCursor)
@@ -192,6 +194,8 @@ class CfdPreferencePage:
                 self.consoleMessage("Download unsuccessful")
 
     def installFinished(self, exit_code):
+        # The result of the dependency check may have changed
+        CfdTools.clearDependencyCache()
         if exit_code:
             self.consoleMessage("Install finished with error {}".format(exit_code))
         else:
@@ -238,7 +242,8 @@ class CfdPreferencePageThread(QThread):
 
     def dependencyCheck(self):
         self.signals.status.emit("Checking dependencies...")
-        msg = CfdTools.checkCfdDependencies()
+        # Probe afresh, since the check is typically rerun just after installing a missing dependency
+        msg = CfdTools.checkCfdDependencies(use_cache=False)
         if not msg:
             self.signals.status.emit("No missing dependencies detected")
         else:
@@ -28,8 +28,6 @@ __author__ = "Qingfeng Xia"
 __url__ = "http://www.freecadweb.org"
 
 import os.path
-import Gnuplot
-from numpy import *
 
 import FreeCAD
 
@@ -88,7 +86,11 @@ class CfdRunnable(object):
 class CfdRunnableFoam(CfdRunnable):
     def __init__(self, analysis=None, solver=None):
         super(CfdRunnableFoam, self).__init__(analysis, solver)
-        self.writer = CfdCaseWriterFoam.CfdCaseWriterFoam(self.analysis)
+        # Rewriting an existing case only replaces the files and mesh which have changed
+        self.writer = CfdCaseWriterFoam.CfdCaseWriterFoam(self.analysis, updating=True)
+
+        # Only loaded once a solver is to be run
+        import Gnuplot
 
         # Set default windows executable to gnuplot instead of older pgnuplot
         import platform
@@ -151,6 +153,7 @@ class CfdRunnableFoam(CfdRunnable):
         return os.path.join(self.writer.case_folder, "pvScript.py")
 
     def process_output(self, text):
+        import Gnuplot
         loglines = text.split('\n')
         printlines = []
         for line in loglines:
@@ -36,17 +36,20 @@ import numbers
 import platform
 import subprocess
 import sys
+import hashlib
+import itertools
+import json
+import math
+import time
 
 import FreeCAD
-import Fem
 import Units
 import CfdConsoleProcess
+from PySide import QtCore
 
 if FreeCAD.GuiUp:
     import FreeCADGui
-    import FemGui
     from PySide import QtGui
-    from PySide import QtCore
 
 # Some standard install locations that are searched if an install directory is not specified
 FOAM_DIR_DEFAULTS = {"Windows": ["C:\\Program Files\\blueCFD-Core-2016\\OpenFOAM-4.x"],
@@ -289,6 +292,12 @@ def get_module_path():
     return os.path.dirname(__file__)
 
 
+def getCacheDir(name):
+    """ Directory of the named cache, kept in the user's FreeCAD data folder so that it persists between sessions
+    and does not depend on the module folder being writable """
+    return os.path.join(FreeCAD.getUserAppDataDir(), "CfdOF", "cache", name)
+
+
 # Set functions
 
 def setCompSolid(vobj):
@@ -303,6 +312,7 @@ def setCompSolid(vobj):
 # UNV mesh writer
 
 def write_unv_mesh(mesh_obj, bc_group, mesh_file_name):
+    import Fem
     __objs__ = []
     __objs__.append(mesh_obj)
     FreeCAD.Console.PrintMessage("Export FemMesh to UNV format file: {}\n".format(mesh_file_name))
@@ -313,34 +323,372 @@ def write_unv_mesh(mesh_obj, bc_group, mesh_file_name):
 
 
 def _write_unv_bc_mesh(mesh_obj, bc_group, unv_mesh_file):
-    f = open(unv_mesh_file, 'a')  # Appending bc to the volume mesh, which contains node and
-                                  # element definition, ends with '-1'
-    f.write("{:6d}\n".format(-1))  # Start of a section
-    f.write("{:6d}\n".format(2467))  # Group section
+    """ Append the boundary condition face groups to the volume mesh, which contains node and element definitions,
+    and ends with '-1'. The groups are formatted in memory and written in one go. """
+    face_cache = {}  # Reference -> mesh face ids
+    sections = ["{:6d}\n".format(-1),  # Start of a section
+                "{:6d}\n".format(2467)]  # Group section
     for bc_id, bc_obj in enumerate(bc_group):
-        _write_unv_bc_faces(mesh_obj, f, bc_id + 1, bc_obj)
-    f.write("{:6d}\n".format(-1))  # end of a section
-    f.write("{:6d}\n".format(-1))  # end of file
-    f.close()
-
-
-def _write_unv_bc_faces(mesh_obj, f, bc_id, bc_object):
-    facet_list = []
+        start = time.time()
+        record, nr_facets = _unv_bc_faces(mesh_obj, bc_id + 1, bc_obj, face_cache)
+        sections.append(record)
+        FreeCAD.Console.PrintMessage("Boundary {}: {} faces in {:.3f} s\n".format(
+            bc_obj.Label, nr_facets, time.time() - start))
+    sections.append("{:6d}\n".format(-1))  # end of a section
+    sections.append("{:6d}\n".format(-1))  # end of file
+    with open(unv_mesh_file, 'a') as f:
+        f.write(''.join(sections))
+
+
+def _unv_bc_faces(mesh_obj, bc_id, bc_object, face_cache):
+    """ Return the UNV dataset 2467 group record for a boundary condition, and its number of faces """
+    import numpy
+    facets = []
     for o, e in bc_object.References:  # List of (ObjectName, StringName)
-        import FreeCADGui
-        obj = FreeCADGui.activeDocument().Document.getObject(o)
-        elem = obj.Shape.getElement(e)
-        if elem.ShapeType == 'Face':  # OpenFOAM needs only 2D face boundary for 3D model, normally
-            ret = mesh_obj.FemMesh.getFacesByFace(elem)  # FemMeshPyImp.cpp
-            facet_list.extend(i for i in ret)
-    nr_facets = len(facet_list)
-    f.write("{:>10d}         0         0         0         0         0         0{:>10d}\n".format(bc_id, nr_facets))
-    f.writelines(bc_object.Label + "\n")
-    for i in range(int(nr_facets / 2)):
-        f.write("         8{:>10d}         0         0         ".format(facet_list[2 * i]))
-        f.write("         8{:>10d}         0         0         \n".format(facet_list[2 * i + 1]))
+        if (o, e) not in face_cache:
+            elem = bc_object.Document.getObject(o).Shape.getElement(e)
+            faces = []
+            if elem.ShapeType == 'Face':  # OpenFOAM needs only 2D face boundary for 3D model, normally
+                faces = mesh_obj.FemMesh.getFacesByFace(elem)  # FemMeshPyImp.cpp
+            face_cache[(o, e)] = numpy.array(faces, dtype=numpy.int64)
+        facets.append(face_cache[(o, e)])
+    facet_ids = numpy.concatenate(facets) if facets else numpy.zeros(0, dtype=numpy.int64)
+    nr_facets = len(facet_ids)
+    record = "{:>10d}         0         0         0         0         0         0{:>10d}\n".format(bc_id, nr_facets)
+    record += bc_object.Label + "\n"
+    # Two entities per line
+    entry = "         8%10d         0         0         "
+    npairs = nr_facets // 2
+    record += ((entry + entry + "\n") * npairs) % tuple(facet_ids[:2*npairs].tolist())
     if nr_facets % 2:
-        f.write("         8{:>10d}         0         0         \n".format(facet_list[-1]))
+        record += (entry + "\n") % facet_ids[-1]
+    return record, nr_facets
+
+
+# Native polyMesh writer
+
+# Corner node count of FemMesh volume elements by their total number of nodes (including mid-side nodes)
+VOLUME_CORNER_NODES = {4: 4, 10: 4, 5: 5, 13: 5, 6: 6, 15: 6, 8: 8, 20: 8}
+# Corner node count of FemMesh face elements by their total number of nodes
+FACE_CORNER_NODES = {3: 3, 6: 3, 4: 4, 8: 4}
+# Faces of each volume element type as cycles of its corner nodes in SMDS ordering. Triangles are padded with -1 so
+# that all faces can be held in one array. The orientation is fixed up geometrically, so need not be consistent.
+VOLUME_FACES = {
+    4: [(0, 1, 2, -1), (0, 1, 3, -1), (1, 2, 3, -1), (0, 2, 3, -1)],
+    5: [(0, 1, 2, 3), (0, 1, 4, -1), (1, 2, 4, -1), (2, 3, 4, -1), (3, 0, 4, -1)],
+    6: [(0, 1, 2, -1), (3, 4, 5, -1), (0, 1, 4, 3), (1, 2, 5, 4), (2, 0, 3, 5)],
+    8: [(0, 1, 2, 3), (4, 5, 6, 7), (0, 1, 5, 4), (1, 2, 6, 5), (2, 3, 7, 6), (3, 0, 4, 7)]}
+
+
+def getPolyMeshSource(mesh_obj, bc_group):
+    """ Gather what is needed to write the gmsh-created FemMesh as a polyMesh: the arrays returned by femMeshArrays
+    and the patches, as (name, type) pairs for each boundary condition. Baffles have type None, since they are only
+    face zones in the mesh, and are turned into patches by createBaffles. """
+    points, cells, groups = femMeshArrays(mesh_obj, bc_group)
+    patches = []
+    for bc_obj in bc_group:
+        bc_type = bc_obj.BoundarySettings['BoundaryType']
+        if bc_type == 'baffle':
+            patch_type = None
+        else:
+            patch_type = getPatchType(bc_type, bc_obj.BoundarySettings['BoundarySubtype'])
+        patches.append((bc_obj.Label, patch_type))
+    return points, cells, groups, patches
+
+
+# Bump whenever the meshes written by write_polymesh change, so that meshes cached by an earlier version are not used
+POLYMESH_WRITER_VERSION = 1
+
+
+def hashPolyMeshSource(source, *parts):
+    """ Return a hash of the source returned by getPolyMeshSource and any other values affecting the mesh written """
+    points, cells, groups, patches = source
+    h = hashlib.sha1()
+    h.update("{!r} {!r}\n".format(patches, parts).encode('utf-8'))
+    for a in [points] + [cells[n] for n in sorted(cells)] + groups:
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+def write_polymesh(source, mesh_dir, scale, binary=False):
+    """ Write the mesh from getPolyMeshSource as an OpenFOAM polyMesh, replacing any existing one in mesh_dir. This
+    does the job of exporting a UNV file and converting it with ideasUnvToFoam, changeDictionary and transformPoints.
+    Boundary condition faces become patches, or face zones where they are internal faces, and any remaining boundary
+    faces go to a 'defaultFaces' wall patch. """
+    points, cells, groups, patches = source
+    FreeCAD.Console.PrintMessage("Writing polyMesh to {}\n".format(mesh_dir))
+    polymesh = buildPolyMesh(points, cells, groups, patches)
+    removePolyMesh(mesh_dir)
+    writePolyMesh(mesh_dir, polymesh, points*scale, binary)
+
+
+def femMeshArrays(mesh_obj, bc_group):
+    """ Extract from a FemMesh the node coordinates, the volume elements' corner node indices (as an array of
+    cells for each number of corners) and, for each boundary condition, the corner node indices of its faces.
+    Node indices are zero-based. """
+    import numpy
+    fem_mesh = mesh_obj.FemMesh
+    nodes = fem_mesh.Nodes
+    node_ids = numpy.array(sorted(nodes), dtype=numpy.int64)
+    points = numpy.array([tuple(nodes[i]) for i in node_ids.tolist()], dtype=numpy.float64).reshape(-1, 3)
+    node_index = numpy.full(node_ids[-1] + 1 if len(node_ids) else 0, -1, dtype=numpy.int64)
+    node_index[node_ids] = numpy.arange(len(node_ids))
+
+    cells = {}
+    for vol in fem_mesh.Volumes:
+        elem_nodes = fem_mesh.getElementNodes(vol)
+        n = VOLUME_CORNER_NODES[len(elem_nodes)]
+        cells.setdefault(n, []).append(elem_nodes[:n])
+    cells = dict((n, node_index[numpy.array(c, dtype=numpy.int64)]) for n, c in cells.items())
+
+    groups = []
+    for bc_obj in bc_group:
+        faces = []
+        for o, e in bc_obj.References:  # List of (ObjectName, StringName)
+            elem = bc_obj.Document.getObject(o).Shape.getElement(e)
+            if elem.ShapeType == 'Face':
+                for face in fem_mesh.getFacesByFace(elem):
+                    face_nodes = fem_mesh.getElementNodes(face)
+                    corners = face_nodes[:FACE_CORNER_NODES[len(face_nodes)]]
+                    faces.append(tuple(corners) + (-1,)*(4 - len(corners)))
+        face_nodes = numpy.array(faces, dtype=numpy.int64).reshape(-1, 4)
+        groups.append(numpy.where(face_nodes < 0, -1, node_index[face_nodes]))
+    return points, cells, groups
+
+
+def uniqueRowLabels(keys):
+    """ Label each row of the integer array so that equal rows get the same label. Returns (labels, nlabels).
+    Equivalent to numpy.unique(keys, axis=0, return_inverse=True), which older NumPy versions lack. """
+    import numpy
+    if not len(keys):
+        return numpy.zeros(0, dtype=numpy.int64), 0
+    order = numpy.lexsort(keys.T[::-1])
+    sorted_keys = keys[order]
+    new_row = numpy.ones(len(keys), dtype=bool)
+    new_row[1:] = numpy.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)
+    labels = numpy.empty(len(keys), dtype=numpy.int64)
+    labels[order] = numpy.cumsum(new_row) - 1
+    return labels, int(new_row.sum())
+
+
+def buildPolyMesh(points, cells, groups, patches):
+    """ Build polyMesh connectivity from volume cells given as corner node indices, keyed by the number of corners.
+    groups holds an array of face corner node indices (padded with -1 for triangles) for each of the patches, which
+    are (name, type) pairs, where a type of None only defines a face zone. Returns a dict of arrays: faces (padded
+    with -1), owner, neighbour, the boundary as a list of (name, type, nFaces, startFace), and the face zones as a
+    list of (name, face labels). """
+    import numpy
+    # Every face of every cell, with the cell it belongs to
+    cell_faces = []
+    face_cells = []
+    ncells = 0
+    for n in sorted(cells):
+        c = cells[n]
+        template = numpy.array(VOLUME_FACES[n])
+        f = numpy.where(template < 0, -1, c[:, numpy.where(template < 0, 0, template)])
+        cell_faces.append(f.reshape(-1, 4))
+        face_cells.append(numpy.repeat(numpy.arange(ncells, ncells + len(c)), len(template)))
+        ncells += len(c)
+    faces = numpy.concatenate(cell_faces) if cell_faces else numpy.zeros((0, 4), dtype=numpy.int64)
+    face_cells = numpy.concatenate(face_cells) if face_cells else numpy.zeros(0, dtype=numpy.int64)
+    cell_index = dict(zip(sorted(cells), numpy.cumsum([0] + [len(cells[n]) for n in sorted(cells)])))
+
+    # Orient each face outward from its cell. Taking the fourth corner of a triangle to be its first, the normal of
+    # both triangles and quads is the cross product of the diagonals.
+    is_tri = faces[:, 3] < 0
+    p0 = points[faces[:, 0]]
+    p3 = points[numpy.where(is_tri, faces[:, 0], faces[:, 3])]
+    normal = numpy.cross(points[faces[:, 2]] - p0, p3 - points[faces[:, 1]])
+    cell_centre = numpy.empty((ncells, 3))
+    for n in sorted(cells):
+        cell_centre[cell_index[n]:cell_index[n] + len(cells[n])] = points[cells[n]].mean(axis=1)
+    inward = numpy.einsum('ij,ij->i', normal, p0 - cell_centre[face_cells]) < 0
+    faces[inward & is_tri] = faces[inward & is_tri][:, [0, 2, 1, 3]]
+    faces[inward & ~is_tri] = faces[inward & ~is_tri][:, [0, 3, 2, 1]]
+
+    # Match up the two sides of internal faces, and the boundary group faces
+    ngroup_faces = [len(g) for g in groups]
+    keys = numpy.sort(numpy.concatenate([faces] + list(groups)), axis=1)
+    labels, nlabels = uniqueRowLabels(keys)
+    face_labels = labels[:len(faces)]
+    counts = numpy.bincount(face_labels, minlength=nlabels)
+    if numpy.any(counts > 2):
+        raise RuntimeError("Mesh is not manifold: a face is shared by more than two cells")
+    order = numpy.argsort(face_labels, kind='mergesort')
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = face_labels[order][1:] != face_labels[order][:-1]
+    pairs = numpy.nonzero(~first)[0]
+    side_a, side_b = order[pairs - 1], order[pairs]
+    owner = numpy.minimum(face_cells[side_a], face_cells[side_b])
+    neighbour = numpy.maximum(face_cells[side_a], face_cells[side_b])
+    owner_side = numpy.where(face_cells[side_a] <= face_cells[side_b], side_a, side_b)
+    # Upper-triangular order
+    internal_order = numpy.lexsort((neighbour, owner))
+    internal = owner_side[internal_order]
+    owner = owner[internal_order]
+    neighbour = neighbour[internal_order]
+
+    boundary = order[first & (counts[face_labels[order]] == 1)]
+    # Label of each face -> index in internal faces or boundary faces
+    internal_of_label = numpy.full(nlabels, -1, dtype=numpy.int64)
+    internal_of_label[face_labels[internal]] = numpy.arange(len(internal))
+    boundary_of_label = numpy.full(nlabels, -1, dtype=numpy.int64)
+    boundary_of_label[face_labels[boundary]] = numpy.arange(len(boundary))
+
+    npatches = len(patches)
+    boundary_patch = numpy.full(len(boundary), npatches, dtype=numpy.int64)  # Default patch last
+    face_zones = []
+    start = len(faces)
+    for i, ((name, patch_type), nfaces) in enumerate(zip(patches, ngroup_faces)):
+        group_labels = labels[start:start + nfaces]
+        start += nfaces
+        in_boundary = boundary_of_label[group_labels]
+        if patch_type is not None:
+            boundary_patch[in_boundary[in_boundary >= 0]] = i
+        in_internal = numpy.unique(internal_of_label[group_labels])
+        in_internal = in_internal[in_internal >= 0]
+        if len(in_internal):
+            face_zones.append((name, in_internal))
+
+    boundary_order = numpy.lexsort((face_cells[boundary], boundary_patch))
+    boundary = boundary[boundary_order]
+    boundary_patch = boundary_patch[boundary_order]
+    patch_sizes = numpy.bincount(boundary_patch, minlength=npatches + 1)
+    boundary_info = []
+    start_face = len(internal)
+    for i, (name, patch_type) in enumerate(list(patches) + [('defaultFaces', 'wall')]):
+        if patch_type is not None and (i < npatches or patch_sizes[i]):
+            boundary_info.append((name, patch_type, int(patch_sizes[i]), start_face))
+        start_face += int(patch_sizes[i])
+
+    return {'faces': faces[numpy.concatenate([internal, boundary])],
+            'owner': numpy.concatenate([owner, face_cells[boundary]]),
+            'neighbour': neighbour,
+            'boundary': boundary_info,
+            'faceZones': face_zones,
+            'nCells': ncells}
+
+
+def writePolyMesh(mesh_dir, polymesh, points, binary=False):
+    """ Write the polyMesh built by buildPolyMesh, with the given (scaled) points, to mesh_dir """
+    import numpy
+    if not os.path.isdir(mesh_dir):
+        os.makedirs(mesh_dir)
+    faces = polymesh['faces']
+    is_tri = faces[:, 3] < 0
+    note = "nPoints:{} nCells:{} nFaces:{} nInternalFaces:{}".format(
+        len(points), polymesh['nCells'], len(faces), len(polymesh['neighbour']))
+    with open(os.path.join(get_module_path(), 'data', 'defaults', '_header')) as f:
+        banner = f.read()
+
+    def header(cls, obj, binary_data=False, with_note=False):
+        text = banner + "FoamFile\n{{\n    version     2.0;\n    format      {};\n".format(
+            "binary" if binary_data else "ascii")
+        if binary_data:
+            text += "    arch        \"LSB;label=32;scalar=64\";\n"
+        text += "    class       {};\n".format(cls)
+        if with_note:
+            text += "    note        \"{}\";\n".format(note)
+        text += "    location    \"constant/polyMesh\";\n    object      {};\n}}\n".format(obj)
+        text += "// * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * //\n\n"
+        return text.encode('ascii')
+
+    def listData(values, dtype, ascii_format):
+        if binary:
+            data = numpy.ascontiguousarray(values, dtype=numpy.dtype(dtype).newbyteorder('<')).tobytes()
+            return "{}\n(".format(len(values)).encode('ascii') + data + b")\n"
+        else:
+            text = "{}\n(\n".format(len(values)) + ''.join(ascii_format(v) for v in values.tolist()) + ")\n"
+            return text.encode('ascii')
+
+    def writeFile(name, cls, data, with_note=False):
+        with open(os.path.join(mesh_dir, name), 'wb') as f:
+            f.write(header(cls, name, binary, with_note))
+            f.write(data)
+
+    writeFile('points', 'vectorField', listData(points, numpy.float64, lambda p: "(%.12g %.12g %.12g)\n" % tuple(p)))
+    if binary:
+        # Compact form: offsets into a flat list of vertex labels
+        offsets = numpy.concatenate([[0], numpy.cumsum(numpy.where(is_tri, 3, 4))])
+        writeFile('faces', 'faceCompactList', listData(offsets, numpy.int32, None) + b"\n" +
+                  listData(faces[faces >= 0], numpy.int32, None))
+    else:
+        writeFile('faces', 'faceList', listData(faces, numpy.int32, lambda v: "3(%d %d %d)\n" % tuple(v[:3])
+                                                if v[3] < 0 else "4(%d %d %d %d)\n" % tuple(v)))
+    writeFile('owner', 'labelList', listData(polymesh['owner'], numpy.int32, lambda i: "%d\n" % i), True)
+    writeFile('neighbour', 'labelList', listData(polymesh['neighbour'], numpy.int32, lambda i: "%d\n" % i), True)
+
+    text = "{}\n(\n".format(len(polymesh['boundary']))
+    for name, patch_type, nfaces, start_face in polymesh['boundary']:
+        text += "    {}\n    {{\n        type            {};\n        nFaces          {};\n" \
+                "        startFace       {};\n    }}\n".format(name, patch_type, nfaces, start_face)
+    text += ")\n"
+    with open(os.path.join(mesh_dir, 'boundary'), 'wb') as f:
+        f.write(header('polyBoundaryMesh', 'boundary'))
+        f.write(text.encode('utf-8'))
+
+    # Always ascii, being a dictionary of lists
+    zones_file = os.path.join(mesh_dir, 'faceZones')
+    if polymesh['faceZones']:
+        text = "{}\n(\n".format(len(polymesh['faceZones']))
+        for name, zone_faces in polymesh['faceZones']:
+            text += "{}\n{{\n    type faceZone;\n    faceLabels List<label> {}\n(\n".format(name, len(zone_faces))
+            text += ''.join("%d\n" % i for i in zone_faces.tolist())
+            text += ")\n;\n    flipMap List<bool> {}{{0}};\n}}\n".format(len(zone_faces))
+        text += ")\n"
+        with open(zones_file, 'wb') as f:
+            f.write(header('regIOobject', 'faceZones'))
+            f.write(text.encode('utf-8'))
+    elif os.path.exists(zones_file):
+        os.remove(zones_file)
+
+
+# STL surface writer
+
+def meshTriangles(mesh):
+    """ Vertex coordinates of the facets of a Mesh, as an array of shape (nFacets, 3, 3) """
+    import numpy
+    points, facets = mesh.Topology
+    points = numpy.array([tuple(p) for p in points], dtype=numpy.float64).reshape(-1, 3)
+    return points[numpy.array(facets, dtype=numpy.int64).reshape(-1, 3)]
+
+
+def writeSTL(file_name, solids, scale=1.0, binary=False):
+    """ Write a list of (name, triangles) solids, with triangles as from meshTriangles, to an STL file after
+    scaling the coordinates. ASCII files hold each solid under its name. Binary STL has no room for names, so
+    solids are instead identified by their index in the facet attribute, which OpenFOAM reads as the region
+    number; binary output should therefore only be used where the solid names are not needed. """
+    import numpy
+    triangles = [numpy.asarray(t, dtype=numpy.float64).reshape(-1, 3, 3)*scale for _, t in solids]
+    normals = []
+    for t in triangles:
+        n = numpy.cross(t[:, 1] - t[:, 0], t[:, 2] - t[:, 0])
+        mag = numpy.sqrt((n*n).sum(axis=1))
+        normals.append(n/numpy.where(mag > 0, mag, 1.0)[:, None])
+
+    if binary:
+        facet = numpy.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attribute', '<u2')])
+        data = numpy.zeros(sum(len(t) for t in triangles), dtype=facet)
+        start = 0
+        for i, (t, n) in enumerate(zip(triangles, normals)):
+            data['normal'][start:start + len(t)] = n
+            data['vertices'][start:start + len(t)] = t
+            data['attribute'][start:start + len(t)] = i
+            start += len(t)
+        with open(file_name, 'wb') as f:
+            # The header must not begin with 'solid', which would mark the file as ASCII
+            f.write(b"CfdOF binary STL".ljust(80, b' '))
+            f.write(numpy.array([len(data)], dtype='<u4').tobytes())
+            f.write(data.tobytes())
+    else:
+        facet = " facet normal %.12g %.12g %.12g\n  outer loop\n" + "    vertex %.12g %.12g %.12g\n"*3 + \
+                "  endloop\n endfacet\n"
+        with open(file_name, 'w') as f:
+            for (name, _), t, n in zip(solids, triangles, normals):
+                values = numpy.concatenate([n, t.reshape(-1, 9)], axis=1).ravel().tolist()
+                f.write("solid {}\n".format(name))
+                f.write((facet*len(t)) % tuple(values))
+                f.write("endsolid {}\n".format(name))
 
 
 def normalise(v):
@@ -393,6 +741,7 @@ def indexOrDefault(list, findItem, defaultIndex):
 
 def hide_parts_show_meshes():
     if FreeCAD.GuiUp:
+        import FemGui
         for acnstrmesh in FemGui.getActiveAnalysis().Group:
             if "Mesh" in acnstrmesh.TypeId:
                 aparttoshow = acnstrmesh.Name.replace("_Mesh", "")
@@ -402,15 +751,81 @@ def hide_parts_show_meshes():
                 acnstrmesh.ViewObject.Visibility = True
 
 
-def copyFilesRec(src, dst, symlinks=False, ignore=None):
-    """ Recursively copy files from src dir to dst dir """
+def copyFilesRec(src, dst, symlinks=False, ignore=None, mode="copy"):
+    """ Recursively copy files from src dir to dst dir. See transferFile for the transfer modes. """
     if not os.path.exists(dst):
         os.makedirs(dst)
     for item in os.listdir(src):
         s = os.path.join(src, item)
         d = os.path.join(dst, item)
         if not os.path.isdir(s):
-            shutil.copy2(s, d)
+            transferFile(s, d, mode)
+
+
+# Linux ioctl to make a file share the data blocks of another until either is modified
+FICLONE = 0x40049409
+
+
+def transferFile(src, dst, mode="copy"):
+    """ Copy or move a file. Apart from "copy", the modes avoid copying the data where the file system allows:
+    "move" renames the file, "hardlink" links dst to the same data as src (so that a change to one is seen in the
+    other) and "reflink" makes a copy-on-write clone, which is as safe as a copy. Otherwise the file is copied. """
+    if mode == "move":
+        shutil.move(src, dst)
+        return
+    elif mode == "hardlink":
+        try:
+            if os.path.lexists(dst):
+                os.remove(dst)
+            os.link(src, dst)
+            return
+        except (OSError, AttributeError):  # os.link is not available on Windows in Python 2
+            pass
+    elif mode == "reflink":
+        if reflinkFile(src, dst):
+            return
+    shutil.copy2(src, dst)
+
+
+def reflinkFile(src, dst):
+    """ Clone src to dst as a copy-on-write reflink, returning False if not supported """
+    if platform.system() != 'Linux':
+        return False
+    import fcntl
+    try:
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (IOError, OSError):
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def hashFiles(paths):
+    """ Return a hash of the contents of the listed files. Files which do not exist are skipped. """
+    h = hashlib.sha1()
+    for p in paths:
+        if os.path.isfile(p):
+            h.update("{} {}\n".format(os.path.basename(p), os.path.getsize(p)).encode('utf-8'))
+            with open(p, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+    return h.hexdigest()
+
+
+def hashFileStats(dirs):
+    """ Return a hash of the names, sizes and modification times of the files in the listed directories, which is
+    much cheaper than hashing their contents but still changes whenever a file is rewritten. """
+    h = hashlib.sha1()
+    for d in dirs:
+        if os.path.isdir(d):
+            for item in sorted(os.listdir(d)):
+                p = os.path.join(d, item)
+                if os.path.isfile(p):
+                    st = os.stat(p)
+                    h.update("{} {} {!r}\n".format(p, st.st_size, st.st_mtime).encode('utf-8'))
+    return h.hexdigest()
 
 
 def getPatchType(bcType, bcSubType):
@@ -432,14 +847,85 @@ def getPatchType(bcType, bcSubType):
         return 'patch'
 
 
+def removePolyMesh(mesh_dir):
+    """ Remove the polyMesh directory mesh_dir before a new mesh is written to it. Once Allrun has been run, it
+    consists of links into polyMesh.org, which must not be written through. """
+    if os.path.islink(mesh_dir):
+        os.remove(mesh_dir)
+    elif os.path.isdir(mesh_dir):
+        shutil.rmtree(mesh_dir)
+
+
+def transferPolyMesh(src, mesh_dir, mode="copy"):
+    """ Replace the polyMesh directory mesh_dir with the files of the one in src. See transferFile for the modes. """
+    removePolyMesh(mesh_dir)
+    copyFilesRec(src, mesh_dir, mode=mode)
+
+
 def movePolyMesh(case):
     """ Move polyMesh to polyMesh.org to ensure availability if cleanCase is ran from the terminal. """
     meshOrg_dir = case + os.path.sep + "constant/polyMesh.org"
     mesh_dir = case + os.path.sep + "constant/polyMesh"
     if os.path.isdir(meshOrg_dir):
         shutil.rmtree(meshOrg_dir)
-    shutil.copytree(mesh_dir, meshOrg_dir)
-    shutil.rmtree(mesh_dir)
+    # Renames if possible rather than copying
+    shutil.move(mesh_dir, meshOrg_dir)
+
+
+def makeStagingDir(path):
+    """ Create an empty staging directory next to the directory path, in which its replacement can be written """
+    staging_dir = path + ".staging"
+    if os.path.isdir(staging_dir):
+        shutil.rmtree(staging_dir)
+    os.makedirs(staging_dir)
+    return staging_dir
+
+
+def commitStagingDir(staging_dir, path, backup_path=None, fsync=False):
+    """ Replace the directory path with staging_dir by renaming, so that the directory is never seen partially
+    written. If fsync, the contents are first flushed to disk so that they also survive a system crash. If
+    backup_path is given, the previous directory is moved there instead of being deleted. """
+    if fsync:
+        fsyncTree(staging_dir)
+    old_dir = backup_path if backup_path else path + ".old"
+    if os.path.isdir(path):
+        if backup_path:
+            shutil.move(path, backup_path)
+        else:
+            if os.path.isdir(old_dir):
+                shutil.rmtree(old_dir)
+            os.rename(path, old_dir)
+    os.rename(staging_dir, path)
+    if fsync:
+        fsyncDir(os.path.dirname(path))
+    if not backup_path and os.path.isdir(old_dir):
+        shutil.rmtree(old_dir)
+
+
+def fsyncTree(path):
+    """ Flush all files and directory entries under path to disk """
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            fd = os.open(os.path.join(root, f), os.O_RDWR)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        fsyncDir(root)
+
+
+def fsyncDir(path):
+    """ Flush directory entries to disk. Not possible on Windows, where this is skipped. """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
 
 
 def getPreferencesLocation():
@@ -453,24 +939,65 @@ def setFoamDir(installation_path):
     FreeCAD.ParamGet(prefs).SetString("InstallationPath", installation_path)
 
 
+# Result of the last OpenFOAM installation discovery, along with the preference setting and bashrc modification time
+# it was based on
+_foam_discovery = {}
+
+
+def bashrcModificationTime(installation_path):
+    try:
+        return os.path.getmtime(os.path.join(installation_path, "etc", "bashrc"))
+    except (OSError, TypeError):
+        return None
+
+
 def getFoamDir():
+    """ Return the OpenFOAM installation directory, from the preferences or otherwise detected. The result is
+        remembered until the preference setting or the installation's bashrc changes, or refreshFoamDiscovery is
+        called. """
     prefs = getPreferencesLocation()
     # Get OpenFOAM install path from parameters
     installation_path = FreeCAD.ParamGet(prefs).GetString("InstallationPath", "")
+    if _foam_discovery.get('preference') == installation_path and \
+       _foam_discovery['bashrc_mtime'] == bashrcModificationTime(_foam_discovery['installation_path']):
+        return _foam_discovery['installation_path']
     # Ensure parameters exist for future editing
     setFoamDir(installation_path)
 
     if installation_path and \
        (not os.path.isabs(installation_path) or not os.path.exists(os.path.join(installation_path, "etc", "bashrc"))):
+        _foam_discovery.clear()
         raise IOError("The directory {} is not a valid OpenFOAM installation".format(installation_path))
 
+    preference = installation_path
     # If not specified, try to detect from shell environment settings and defaults
     if not installation_path:
         installation_path = detectFoamDir()
 
+    _foam_discovery.clear()
+    _foam_discovery.update({'preference': preference,
+                            'installation_path': installation_path,
+                            'bashrc_mtime': bashrcModificationTime(installation_path)})
     return installation_path
 
 
+def getFoamVersion():
+    """ Return the version of the OpenFOAM installation as a string, or None if it can't be determined. Remembered
+        along with the installation directory. """
+    installation_path = getFoamDir()
+    if 'version' not in _foam_discovery:
+        foam_env = getFoamEnvironment(installation_path) if installation_path else None
+        _foam_discovery['version'] = foam_env.get('WM_PROJECT_VERSION') if foam_env else None
+    return _foam_discovery['version']
+
+
+def refreshFoamDiscovery():
+    """ Forget the discovered OpenFOAM installation and its captured environment, so that they are looked up again
+        e.g. after installing or modifying OpenFOAM """
+    _foam_discovery.clear()
+    _foam_environment_cache.clear()
+
+
 def getFoamRuntime():
     if platform.system() == 'Windows':
         #if os.path.exists(os.path.join(getFoamDir(), "..", "msys64")):
@@ -598,6 +1125,65 @@ def getRunEnvironment():
         return {}
 
 
+# Captured OpenFOAM environments, by bashrc path: (bashrc modification time, environment variables)
+_foam_environment_cache = {}
+
+
+def getFoamEnvironment(installation_path=None):
+    """ Return the environment variables set up by sourcing the bashrc of the OpenFOAM installation, so that
+        OpenFOAM applications can be launched without sourcing it each time. The environment is captured once and
+        cached until the bashrc is modified. Returns None if it can't be captured on this platform.
+    """
+    if getFoamRuntime() != "Posix":
+        return None
+    if installation_path is None:
+        installation_path = getFoamDir()
+        if installation_path is None:
+            return None
+    env_setup_script = os.path.join(installation_path, "etc", "bashrc")
+    try:
+        mtime = os.path.getmtime(env_setup_script)
+    except OSError:
+        return None
+    cached = _foam_environment_cache.get(env_setup_script)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    cmdline = ['bash', '-c', 'source "{}" > /dev/null 2>&1; env -0'.format(env_setup_script)]
+    try:
+        output = subprocess.check_output(cmdline, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if not isinstance(output, str):
+        output = output.decode('utf-8', 'replace')  # Python 3
+    env = {}
+    for entry in output.split('\0'):
+        if '=' in entry:
+            key, value = entry.split('=', 1)
+            env[key] = value
+    # Variables belonging to the capturing shell itself
+    for key in ['_', 'PWD', 'OLDPWD', 'SHLVL']:
+        env.pop(key, None)
+    if 'WM_PROJECT_DIR' not in env:
+        return None
+    _foam_environment_cache[env_setup_script] = (mtime, env)
+    return env
+
+
+def makeFoamRunCommand(cmd, dir):
+    """ Generate native command to run the specified Linux command in the OpenFOAM environment, along with the
+        environment variables to run it with. Where the OpenFOAM environment has been captured, it is passed in the
+        environment variables instead of sourcing the bashrc in the command.
+        Returns (cmdline, env_vars)
+    """
+    env_vars = dict(getRunEnvironment())
+    foam_env = getFoamEnvironment()
+    if foam_env is None:
+        return makeRunCommand(cmd, dir), env_vars
+    env_vars.update(foam_env)
+    return makeRunCommand(cmd, dir, source_env=False), env_vars
+
+
 def makeRunCommand(cmd, dir, source_env=True):
     """ Generate native command to run the specified Linux command in the relevant environment,
         including changing to the specified working directory if applicable
@@ -656,7 +1242,8 @@ class CfdFoamProcess:
 
     def run(self, cmdline, case=None):
         print("Running ", cmdline)
-        self.process.start(makeRunCommand(cmdline, case), env_vars=getRunEnvironment())
+        cmd, env_vars = makeFoamRunCommand(cmdline, case)
+        self.process.start(cmd, env_vars=env_vars)
         if not self.process.waitForFinished():
             raise Exception("Unable to run command " + cmdline)
         return self.process.exitCode()
@@ -691,7 +1278,8 @@ def startFoamApplication(cmd, case, finishedHook=None, stdoutHook=None, stderrHo
 
     proc = CfdConsoleProcess.CfdConsoleProcess(finishedHook=finishedHook, stdoutHook=stdoutHook, stderrHook=stderrHook)
     print("Running ", ' '.join(cmds), " -> ", logFile)
-    proc.start(makeRunCommand(cmdline, case), env_vars=getRunEnvironment())
+    cmd, env_vars = makeFoamRunCommand(cmdline, case)
+    proc.start(cmd, env_vars=env_vars)
     if not proc.waitForStarted():
         raise Exception("Unable to start command " + ' '.join(cmds))
     return proc
@@ -704,26 +1292,270 @@ def runFoamApplication(cmd, case):
     return proc.exitCode()
 
 
+class CfdFoamSession:
+    """ Long-lived shell in which the OpenFOAM environment is only sourced once, and which runs a queue of commands
+    one after the other. As with startFoamApplication, each application's output is written to its log file in the
+    case directory and passed to the optional hooks, and its exit code is passed to finishedHook.
+    Commands are passed to the shell on its standard input, which the wrapper process used on Windows does not
+    forward, so there each command is run as a separate process instead. """
+    MARKER = "__CfdFoamSessionDone__"
+
+    def __init__(self):
+        self.process = None
+        self.pending = []  # Commands sent to the shell and not yet finished, in order
+
+    def __del__(self):
+        self.close()
+
+    def start(self):
+        self.process = QtCore.QProcess()
+        cmd, env_vars = makeFoamRunCommand('exec bash -s', None)
+        env = QtCore.QProcessEnvironment.systemEnvironment()
+        for key, value in env_vars.items():
+            env.insert(key, value)
+        self.process.setProcessEnvironment(env)
+        self.process.readyReadStandardOutput.connect(self.readStdout)
+        self.process.readyReadStandardError.connect(self.readStderr)
+        self.process.start(cmd[0], cmd[1:])
+        if not self.process.waitForStarted():
+            raise Exception("Unable to start OpenFOAM session")
+
+    def close(self):
+        """ Exit the shell once the queued commands have finished """
+        if self.process is not None:
+            self.process.write("exit\n")
+            self.process.waitForFinished(-1)
+            self.process = None
+
+    def queueApplication(self, cmd, case, finishedHook=None, stdoutHook=None, stderrHook=None):
+        """ Queue an OpenFOAM application, specified as for startFoamApplication, to run with its output logged to
+        log.application. Returns an object whose exit_code attribute is set once finished. """
+        if isinstance(cmd, list) or isinstance(cmd, tuple):
+            cmds = cmd
+        elif isinstance(cmd, str):
+            cmds = cmd.split(' ')  # Insensitive to incorrect split like space and quote
+        else:
+            raise Exception("Error: Application and options must be specified as a list or tuple.")
+        app = cmds[0].rsplit('/', 1)[-1]
+        logFile = "log.{}".format(app)
+        print("Queueing ", ' '.join(cmds), " -> ", logFile)
+        return self.queueCommand(' '.join(cmds), case, logFile, finishedHook, stdoutHook, stderrHook)
+
+    def queueCommand(self, cmdline, case=None, logFile=None, finishedHook=None, stdoutHook=None, stderrHook=None):
+        """ Queue a command line to run in the OpenFOAM environment, optionally logging its output to a file in the
+        case directory. Returns an object whose exit_code attribute is set once finished. """
+        command = CfdFoamSessionCommand(cmdline, finishedHook, stdoutHook, stderrHook)
+        if platform.system() == 'Windows':
+            if logFile:
+                proc = startFoamApplication(cmdline, case, stdoutHook=command.readStdout,
+                                            stderrHook=command.readStderr)
+            else:
+                proc = CfdConsoleProcess.CfdConsoleProcess(stdoutHook=command.readStdout,
+                                                           stderrHook=command.readStderr)
+                cmd, env_vars = makeFoamRunCommand(cmdline, case)
+                proc.start(cmd, env_vars=env_vars)
+            proc.waitForFinished()
+            command.finish(proc.exitCode())
+            return command
+        if self.process is None:
+            self.start()
+        if logFile:
+            # Pipe stderr and stdout through separate tees to the log file. Unlike process substitution,
+            # pipelines complete before the next command is run, so no output arrives after the end marker.
+            cmdline = "rm -f {log} && {{ {{ {cmd} 2>&1 1>&3 3>&- | tee -a {log} 1>&2; }} 3>&1 | tee -a {log}; }}"\
+                .format(cmd=cmdline, log=logFile)
+        if case:
+            cmdline = 'cd "{}" && {}'.format(translatePath(case), cmdline)
+        # Run in a subshell so that the working directory and options do not carry over to the next command. The
+        # command's output need not end in a newline, so the end marker may follow it on the same line.
+        self.pending.append(command)
+        self.process.write("( set -o pipefail; {} ); printf '%s %d\\n' {} $?\n".format(cmdline, self.MARKER))
+        return command
+
+    def wait(self, command=None):
+        """ Wait until the command, or all queued commands if None, has finished """
+        while self.pending and (command is None or command in self.pending):
+            if not self.process.waitForReadyRead(-1) and self.process.state() == QtCore.QProcess.NotRunning:
+                raise Exception("OpenFOAM session ended unexpectedly")
+
+    def runApplication(self, cmd, case):
+        """ Same as queueApplication, but waits until complete. Returns exit code. """
+        command = self.queueApplication(cmd, case)
+        self.wait(command)
+        return command.exit_code
+
+    def runCommand(self, cmdline, case=None):
+        """ Equivalent of runFoamCommand: runs the command line, waits until complete and returns its output """
+        command = self.queueCommand(cmdline, case)
+        self.wait(command)
+        # Reproduce behaviour of failed subprocess run
+        if command.exit_code:
+            raise subprocess.CalledProcessError(command.exit_code, cmdline)
+        return command.output
+
+    def readStdout(self):
+        while self.process.canReadLine():
+            line = str(self.process.readLine())
+            marker = line.find(self.MARKER)
+            output = line if marker < 0 else line[:marker]
+            if output:
+                print(output, end='')  # Avoid displaying on FreeCAD status bar
+                if self.pending:
+                    self.pending[0].readStdout(output)
+            if marker >= 0:
+                # Any error output of the command has been written by now
+                self.readStderr()
+                self.pending.pop(0).finish(int(line[marker:].split()[1]))
+
+    def readStderr(self):
+        self.process.setReadChannel(QtCore.QProcess.StandardError)
+        text = ""
+        while self.process.canReadLine():
+            text += str(self.process.readLine())
+        self.process.setReadChannel(QtCore.QProcess.StandardOutput)
+        if text:
+            FreeCAD.Console.PrintError(text)
+            if self.pending:
+                self.pending[0].readStderr(text)
+
+
+class CfdFoamSessionCommand:
+    """ A command queued in a CfdFoamSession """
+    def __init__(self, cmdline, finishedHook=None, stdoutHook=None, stderrHook=None):
+        self.cmdline = cmdline
+        self.finishedHook = finishedHook
+        self.stdoutHook = stdoutHook
+        self.stderrHook = stderrHook
+        self.output = ""
+        self.exit_code = None
+
+    def readStdout(self, text):
+        self.output += text
+        if self.stdoutHook:
+            self.stdoutHook(text)
+
+    def readStderr(self, text):
+        self.output += text
+        if self.stderrHook:
+            self.stderrHook(text)
+
+    def finish(self, exit_code):
+        self.exit_code = exit_code
+        if self.finishedHook:
+            self.finishedHook(exit_code)
+
+
 def convertMesh(case, mesh_file, scale):
     """ Convert gmsh created UNV mesh to FOAM. A scaling of 1e-3 is prescribed as the CAD is always in mm while FOAM
-    uses SI units (m). """
-
-    if mesh_file.find(".unv") > 0:
-        mesh_file = translatePath(mesh_file)
-        cmdline = ['ideasUnvToFoam', '"{}"'.format(mesh_file)]
-        runFoamApplication(cmdline, case)
-        # changeBoundaryType(case, 'defaultFaces', 'wall')  # rename default boundary type to wall
-        # Set in the correct patch types
-        cmdline = ['changeDictionary']
-        runFoamApplication(cmdline, case)
-    else:
-        raise Exception("Error: Only supporting unv mesh files.")
+    uses SI units (m). The utilities are run in a single OpenFOAM session. """
 
-    if scale and isinstance(scale, numbers.Number):
-        cmdline = ['transformPoints', '-scale', '"({} {} {})"'.format(scale, scale, scale)]
-        runFoamApplication(cmdline, case)
-    else:
-        print("Error: mesh scaling ratio is must be a float or integer\n")
+    session = CfdFoamSession()
+    try:
+        if mesh_file.find(".unv") > 0:
+            mesh_file = translatePath(mesh_file)
+            cmdline = ['ideasUnvToFoam', '"{}"'.format(mesh_file)]
+            session.queueApplication(cmdline, case)
+            # changeBoundaryType(case, 'defaultFaces', 'wall')  # rename default boundary type to wall
+            # Set in the correct patch types
+            cmdline = ['changeDictionary']
+            session.queueApplication(cmdline, case)
+        else:
+            raise Exception("Error: Only supporting unv mesh files.")
+
+        if scale and isinstance(scale, numbers.Number):
+            cmdline = ['transformPoints', '-scale', '"({} {} {})"'.format(scale, scale, scale)]
+            session.queueApplication(cmdline, case)
+        else:
+            print("Error: mesh scaling ratio is must be a float or integer\n")
+        session.wait()
+    finally:
+        session.close()
+
+
+# Total size of converted meshes kept by MeshCache, in bytes
+MESH_CACHE_MAX_SIZE = 2*1024**3
+# Time after which a converted mesh which has not been used is evicted from MeshCache, in seconds
+MESH_CACHE_MAX_AGE = 30*24*3600
+
+
+class MeshCache(object):
+    """ Content-addressed store of converted polyMesh directories, so that an unchanged mesh need not be converted
+    again. Each entry is a directory named by the hash of its key. Whenever a mesh is stored, entries not used for
+    longer than max_age are evicted, followed by the least recently used entries until the total size is within
+    max_size. """
+    def __init__(self, cache_dir=None, max_size=MESH_CACHE_MAX_SIZE, max_age=MESH_CACHE_MAX_AGE):
+        if cache_dir is None:
+            cache_dir = getCacheDir("meshes")
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_age = max_age
+
+    def key(self, *parts):
+        """ Make a key from the given values, which identify the source of the mesh and how it is converted """
+        h = hashlib.sha1()
+        for p in parts:
+            h.update("{!r}\n".format(p).encode('utf-8'))
+        return h.hexdigest()
+
+    def fetch(self, key, mesh_dir):
+        """ Place the cached mesh into mesh_dir, returning False if it is not in the cache """
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry):
+            return False
+        removePolyMesh(mesh_dir)
+        self.copyTree(entry, mesh_dir)
+        # Mark as recently used
+        os.utime(entry, None)
+        return True
+
+    def store(self, key, mesh_dir):
+        """ Add the mesh in mesh_dir to the cache. Failure to do so is not an error. """
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry):
+            return
+        tmp_entry = None
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp_entry = tempfile.mkdtemp(dir=self.cache_dir, prefix=".")
+            self.copyTree(mesh_dir, tmp_entry)
+            os.rename(tmp_entry, entry)
+            tmp_entry = None
+            self.trim()
+        except EnvironmentError as e:
+            print("Could not cache converted mesh: {}\n".format(e))
+        finally:
+            if tmp_entry:
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    def trim(self):
+        """ Evict the entries not used within the age limit, then the least recently used entries until the total
+        size is within the limit """
+        expiry = time.time() - self.max_age
+        entries = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, key)
+            if key.startswith(".") or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(entry) for f in files)
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_size and mtime >= expiry:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    @staticmethod
+    def copyTree(src, dst):
+        """ Copy a directory tree, cloning the files where the file system allows """
+        for root, dirs, files in os.walk(src):
+            dst_root = os.path.join(dst, os.path.relpath(root, src))
+            if not os.path.isdir(dst_root):
+                os.makedirs(dst_root)
+            for f in files:
+                transferFile(os.path.join(root, f), os.path.join(dst_root, f), mode="reflink")
 
 
 def readTemplate(fileName, replaceDict=None):
@@ -735,138 +1567,188 @@ def readTemplate(fileName, replaceDict=None):
     return helperText
 
 
-def checkCfdDependencies(term_print=True):
-        FC_MINOR_VER_REQUIRED = 17
-        FC_COMMIT_REQUIRED = 12539
+# Seconds for which the result of a dependency probe is reused
+DEPENDENCY_CHECK_TTL = 3600
 
-        import os
-        import subprocess
-        import platform
 
-        message = ""
-        FreeCAD.Console.PrintMessage("Checking CFD workbench dependencies...\n")
+def getDependencyCacheLocation():
+    return getPreferencesLocation() + "/DependencyCheck"
 
-        # Check FreeCAD version
-        if term_print:
-            print("Checking FreeCAD version")
-        ver = FreeCAD.Version()
-        gitver = ver[2].split()[0]
-        if gitver != 'Unknown':
-            gitver = int(gitver)
-        else:
-            # If we don't have the git version, assume it's OK.
-            gitver = FC_COMMIT_REQUIRED
-        if int(ver[0]) == 0 and (int(ver[1]) < FC_MINOR_VER_REQUIRED or
-                                 (int(ver[1]) == FC_MINOR_VER_REQUIRED and gitver < FC_COMMIT_REQUIRED)):
-            fc_msg = "FreeCAD version ({}.{}.{}) must be at least {}.{}.{}".format(
-                int(ver[0]), int(ver[1]), gitver, 0, FC_MINOR_VER_REQUIRED, FC_COMMIT_REQUIRED)
-            if term_print:
-                print(fc_msg)
-            message += fc_msg + '\n'
 
-        # check openfoam
-        if term_print:
-            print("Checking for OpenFOAM:")
+def clearDependencyCache():
+    """ Forget the stored dependency check results, e.g. after installing a dependency """
+    FreeCAD.ParamGet(getDependencyCacheLocation()).Clear()
+
+
+def checkFreeCADVersion():
+    FC_MINOR_VER_REQUIRED = 17
+    FC_COMMIT_REQUIRED = 12539
+
+    messages = []
+    ver = FreeCAD.Version()
+    gitver = ver[2].split()[0]
+    if gitver != 'Unknown':
+        gitver = int(gitver)
+    else:
+        # If we don't have the git version, assume it's OK.
+        gitver = FC_COMMIT_REQUIRED
+    if int(ver[0]) == 0 and (int(ver[1]) < FC_MINOR_VER_REQUIRED or
+                             (int(ver[1]) == FC_MINOR_VER_REQUIRED and gitver < FC_COMMIT_REQUIRED)):
+        messages.append("FreeCAD version ({}.{}.{}) must be at least {}.{}.{}".format(
+            int(ver[0]), int(ver[1]), gitver, 0, FC_MINOR_VER_REQUIRED, FC_COMMIT_REQUIRED))
+    return messages
+
+
+def checkOpenFOAM(foam_dir):
+    messages = []
+    if not foam_dir:
+        messages.append("OpenFOAM installation path not set and OpenFOAM environment neither pre-loaded before " +
+                        "running FreeCAD nor detected in standard locations")
+        return messages
+    # Source the environment only once for all the OpenFOAM checks
+    session = CfdFoamSession()
+    try:
         try:
-            foam_dir = getFoamDir()
-        except IOError as e:
-            ofmsg = "Could not find OpenFOAM installation: " + e.message
-            if term_print:
-                print(ofmsg)
-            message += ofmsg + '\n'
+            # Known without running a shell where the OpenFOAM environment has been captured
+            foam_ver = getFoamVersion()
+            if foam_ver is None:
+                foam_ver = session.runCommand("echo $WM_PROJECT_VERSION").rstrip().split('\n')[-1]
+        except Exception as e:
+            messages.append("OpenFOAM installation found, but unable to run command: " + e.message)
         else:
-            if not foam_dir:
-                ofmsg = "OpenFOAM installation path not set and OpenFOAM environment neither pre-loaded before " + \
-                        "running FreeCAD nor detected in standard locations"
-                if term_print:
-                    print(ofmsg)
-                message += ofmsg + '\n'
+            if int(foam_ver.split('.')[0]) < 4:
+                messages.append("OpenFOAM version " + foam_ver + " pre-loaded is outdated: " +
+                                "The CFD workbench requires at least OpenFOAM 4.0")
             else:
+                # Check for cfMesh
                 try:
-                    foam_ver = runFoamCommand("echo $WM_PROJECT_VERSION")
-                except Exception as e:
-                    runmsg = "OpenFOAM installation found, but unable to run command: " + e.message
-                    message += runmsg + '\n'
-                    if term_print:
-                        print(runmsg)
-                else:
-                    foam_ver = foam_ver.rstrip().split('\n')[-1]
-                    if int(foam_ver.split('.')[0]) < 4:
-                        vermsg = "OpenFOAM version " + foam_ver + " pre-loaded is outdated: " \
-                                   + "The CFD workbench requires at least OpenFOAM 4.0"
-                        message += vermsg + "\n"
-                        if term_print:
-                            print(vermsg)
-                    else:
-                        # Check for cfMesh
-                        try:
-                            runFoamCommand("cartesianMesh -help")
-                        except subprocess.CalledProcessError:
-                            cfmesh_msg = "cfMesh not found"
-                            message += cfmesh_msg + '\n'
-                            if term_print:
-                                print(cfmesh_msg)
-
-        # check for gnuplot python module
-        if term_print:
-            print("Checking for gnuplot:")
-        try:
-            import Gnuplot
-        except ImportError:
-            gnuplotpy_msg = "gnuplot python module not installed"
-            message += gnuplotpy_msg + '\n'
-            if term_print:
-                print(gnuplotpy_msg)
-
-        gnuplot_cmd = "gnuplot"
-        # For blueCFD, use the supplied Gnuplot
-        if getFoamRuntime() == 'BlueCFD':
-            gnuplot_cmd = '{}\\..\\AddOns\\gnuplot\\bin\\gnuplot.exe'.format(getFoamDir())
-        # Otherwise, the command must be in the path - test to see if it exists
-        import distutils.spawn
-        if distutils.spawn.find_executable(gnuplot_cmd) is None:
-            gnuplot_msg = "Gnuplot executable " + gnuplot_cmd + " not found in path."
-            message += gnuplot_msg + '\n'
-            if term_print:
-                print(gnuplot_msg)
+                    session.runCommand("cartesianMesh -help")
+                except subprocess.CalledProcessError:
+                    messages.append("cfMesh not found")
+    finally:
+        session.close()
+    return messages
+
+
+def checkGnuplot(gnuplot_cmd):
+    messages = []
+    # check for gnuplot python module
+    try:
+        import Gnuplot
+    except ImportError:
+        messages.append("gnuplot python module not installed")
+    # The command must be in the path - test to see if it exists
+    import distutils.spawn
+    if distutils.spawn.find_executable(gnuplot_cmd) is None:
+        messages.append("Gnuplot executable " + gnuplot_cmd + " not found in path.")
+    return messages
+
+
+def checkGmsh():
+    messages = []
+    # check that gmsh version 2.13 or greater is installed
+    gmshversion = ""
+    try:
+        gmshversion = subprocess.check_output(["gmsh", "-version"], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        messages.append("gmsh is not installed")
+    if len(gmshversion) > 1:
+        # Only the last line contains gmsh version number
+        gmshversion = gmshversion.decode('utf-8', 'replace') if not isinstance(gmshversion, str) else gmshversion
+        gmshversion = gmshversion.rstrip().split()
+        gmshversion = gmshversion[-1]
+        versionlist = gmshversion.split(".")
+        if int(versionlist[0]) < 2 or (int(versionlist[0]) == 2 and int(versionlist[1]) < 13):
+            messages.append("gmsh version is older than minimum required (2.13)")
+    return messages
+
+
+def checkParaview(paraview_cmd):
+    messages = []
+    # The command must be in the path - test to see if it exists
+    import distutils.spawn
+    if distutils.spawn.find_executable(paraview_cmd) is None:
+        messages.append("Paraview executable " + paraview_cmd + " not found in path.")
+    return messages
+
+
+def getCachedDependencyResult(name, key):
+    """ Return the stored messages of the named dependency probe, or None if there are none from within
+    DEPENDENCY_CHECK_TTL with inputs identified by the same key """
+    try:
+        cached = json.loads(FreeCAD.ParamGet(getDependencyCacheLocation()).GetString(name, ""))
+    except ValueError:
+        return None
+    if cached['key'] == key and 0 <= time.time() - cached['time'] < DEPENDENCY_CHECK_TTL:
+        return cached['messages']
+    return None
+
+
+def storeDependencyResult(name, key, messages):
+    result = {'key': key, 'time': time.time(), 'messages': messages}
+    FreeCAD.ParamGet(getDependencyCacheLocation()).SetString(name, json.dumps(result))
 
-        if term_print:
-            print("Checking for gmsh:")
-        # check that gmsh version 2.13 or greater is installed
-        gmshversion = ""
+
+def checkCfdDependencies(term_print=True, use_cache=True):
+    """ Check the dependencies of the workbench, returning a message describing any that are missing. The
+    probes are run concurrently, and their results are reused for a time unless use_cache is False, which should be
+    used when the check is explicitly requested by the user. Fresh results are cached in either case. """
+    message = ""
+    FreeCAD.Console.PrintMessage("Checking CFD workbench dependencies...\n")
+
+    # Each check: (heading, messages or result of the probe)
+    checks = [("Checking FreeCAD version", checkFreeCADVersion())]
+
+    probes = []
+    try:
+        foam_dir = getFoamDir()
+    except IOError as e:
+        checks.append(("Checking for OpenFOAM:", ["Could not find OpenFOAM installation: " + e.message]))
+    else:
+        probes.append(("Checking for OpenFOAM:", "OpenFOAM",
+                       [foam_dir, bashrcModificationTime(foam_dir)], checkOpenFOAM, (foam_dir,)))
+
+    gnuplot_cmd = "gnuplot"
+    paraview_cmd = "paraview"
+    # If using blueCFD, use the Gnuplot and Paraview supplied
+    if getFoamRuntime() == 'BlueCFD':
+        gnuplot_cmd = '{}\\..\\AddOns\\gnuplot\\bin\\gnuplot.exe'.format(getFoamDir())
+        paraview_cmd = '{}\\..\\AddOns\\ParaView\\bin\\paraview.exe'.format(getFoamDir())
+    probes.append(("Checking for gnuplot:", "gnuplot", [gnuplot_cmd], checkGnuplot, (gnuplot_cmd,)))
+    probes.append(("Checking for gmsh:", "gmsh", [], checkGmsh, ()))
+    probes.append((None, "paraview", [paraview_cmd], checkParaview, (paraview_cmd,)))
+
+    results = {}
+    if use_cache:
+        for heading, name, key, probe, args in probes:
+            results[name] = getCachedDependencyResult(name, key)
+    pending = [p for p in probes if results.get(p[1]) is None]
+    if pending:
+        # The probes are independent, and mostly spend their time waiting on subprocesses
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(len(pending))
         try:
-            gmshversion = subprocess.check_output(["gmsh", "-version"], stderr=subprocess.STDOUT)
-        except OSError or subprocess.CalledProcessError:
-            gmsh_msg = "gmsh is not installed"
-            message += gmsh_msg + '\n'
+            async_results = [pool.apply_async(probe, args) for heading, name, key, probe, args in pending]
+            for (heading, name, key, probe, args), async_result in zip(pending, async_results):
+                results[name] = async_result.get()
+                storeDependencyResult(name, key, results[name])
+        finally:
+            pool.close()
+            pool.join()
+    for heading, name, key, probe, args in probes:
+        checks.append((heading, results[name]))
+
+    for heading, messages in checks:
+        if term_print and heading:
+            print(heading)
+        for msg in messages:
+            message += msg + '\n'
             if term_print:
-                print(gmsh_msg)
-        if len(gmshversion) > 1:
-            # Only the last line contains gmsh version number
-            gmshversion = gmshversion.rstrip().split()
-            gmshversion = gmshversion[-1]
-            versionlist = gmshversion.split(".")
-            if int(versionlist[0]) < 2 or (int(versionlist[0]) == 2 and int(versionlist[1]) < 13):
-                gmsh_ver_msg = "gmsh version is older than minimum required (2.13)"
-                message += gmsh_ver_msg + '\n'
-                if term_print:
-                    print(gmsh_ver_msg)
-
-        paraview_cmd = "paraview"
-        # If using blueCFD, use paraview supplied
-        if getFoamRuntime() == 'BlueCFD':
-            paraview_cmd = '{}\\..\\AddOns\\ParaView\\bin\\paraview.exe'.format(getFoamDir())
-        # Otherwise, the command 'paraview' must be in the path - test to see if it exists
-        import distutils.spawn
-        if distutils.spawn.find_executable(paraview_cmd) is None:
-            pv_msg = "Paraview executable " + paraview_cmd + " not found in path."
-            message += pv_msg + '\n'
-            if term_print:
-                print(pv_msg)
+                print(msg)
 
-        if term_print:
-            print("Completed CFD dependency check")
-        return message
+    if term_print:
+        print("Completed CFD dependency check")
+    return message
 
 
 def floatEqual(a, b):
@@ -912,3 +1794,116 @@ def isSameGeometry(shape1, shape2):
     else:
         return False
 
+
+class FaceIndex:
+    """ Index of a list of faces, for finding those which are the same geometry as a given face in the sense of
+    isSameGeometry without comparing against every face. Faces are bucketed by their number of vertices, and by
+    their centre of mass and area rounded to a grid much coarser than the comparison tolerance, so that only the
+    few faces in the matching buckets are compared exactly. The properties of each face are only read once, since
+    OCC recomputes CenterOfMass and Area on every access. """
+    def __init__(self, faces):
+        self.properties = [self.faceProperties(f) for f in faces]
+        scale = max([max(abs(c) for c in p[0]) for p in self.properties] + [0.0])
+        area_scale = max([p[1] for p in self.properties] + [0.0])
+        self.quanta = [max(1e-6*scale, 1e-9)]*3 + [max(1e-6*area_scale, 1e-9)]
+        self.buckets = {}
+        for i, p in enumerate(self.properties):
+            if p[2]:
+                key = tuple(int(math.floor(v/q)) for v, q in zip(self.keyValues(p), self.quanta))
+                self.buckets.setdefault((len(p[2]),) + key, []).append(i)
+
+    @staticmethod
+    def faceProperties(face):
+        com = face.CenterOfMass
+        return (com[0], com[1], com[2]), face.Area, [(v.X, v.Y, v.Z) for v in face.Vertexes]
+
+    @staticmethod
+    def keyValues(properties):
+        return list(properties[0]) + [properties[1]]
+
+    def find(self, face):
+        """ Return the indices, in ascending order, of the faces which are the same geometry as face """
+        p = self.faceProperties(face)
+        if not p[2]:
+            return []
+        # Values within the comparison tolerance of a grid line may fall on either side of it
+        cells = []
+        for v, q in zip(self.keyValues(p), self.quanta):
+            margin = 2e-12 + 1e-14*abs(v)
+            cells.append(set(int(math.floor(w/q)) for w in (v - margin, v, v + margin)))
+        matches = []
+        for key in itertools.product(*cells):
+            for i in self.buckets.get((len(p[2]),) + key, []):
+                if self.sameProperties(p, self.properties[i]):
+                    matches.append(i)
+        return sorted(matches)
+
+    @staticmethod
+    def sameProperties(p1, p2):
+        """ Equivalent of isSameGeometry on properties from faceProperties """
+        (com1, area1, verts1), (com2, area2, verts2) = p1, p2
+        if len(verts1) != len(verts2) or not verts1:
+            return False
+        if not all(floatEqual(a, b) for a, b in zip(com1, com2)) or not floatEqual(area1, area2):
+            return False
+        for v1 in verts1:
+            if not any(floatEqual(v1[0], v2[0]) and floatEqual(v1[1], v2[1]) and floatEqual(v1[2], v2[2])
+                       for v2 in verts2):
+                return False
+        return True
+
+
+def shapeFingerprint(shape):
+    """ Digest of the BRep of a shape, which unlike hashCode is the same in every session and changes whenever the
+    shape is recomputed into different geometry """
+    brep = shape.exportBrepToString()
+    if not isinstance(brep, bytes):
+        brep = brep.encode('utf-8')
+    return hashlib.sha1(brep).hexdigest()
+
+
+def matchShapeFaces(mesh_obj, references):
+    """ For each (object, element name) reference, find the sorted indices of the faces of the mesh object's part
+    (and hence of its ShapeFaceNames) which are the same geometry as the referenced face. Results are looked up in the
+    mesh object's FaceMapping property against fingerprints of the part and of the referenced object, so they are
+    reused, also in later sessions, until either shape changes. Returns the list of matches and, if any were not
+    cached, the updated mapping to be saved with storeFaceMapping (otherwise None). This does not change the mesh
+    object itself, so may be called from a worker thread. """
+    part_fp = shapeFingerprint(mesh_obj.Part.Shape)
+    cache = getattr(mesh_obj, 'FaceMapping', None)
+    if not cache or cache.get('Part') != part_fp:
+        cache = {'Part': part_fp, 'References': {}}
+    else:
+        # Leave the property's own value untouched
+        cache = {'Part': part_fp, 'References': dict(cache['References'])}
+    cached = cache['References']
+    fingerprints = {}
+    face_index = None
+    changed = False
+    matches = []
+    for obj, elem in references:
+        if obj.Name not in fingerprints:
+            fingerprints[obj.Name] = part_fp if obj == mesh_obj.Part else shapeFingerprint(obj.Shape)
+        key = u"{}:{}".format(obj.Name, elem)
+        entry = cached.get(key)
+        if entry is None or entry[0] != fingerprints[obj.Name]:
+            if face_index is None:
+                face_index = FaceIndex(mesh_obj.Part.Shape.Faces)
+            entry = [fingerprints[obj.Name], face_index.find(obj.Shape.getElement(elem))]
+            cached[key] = entry
+            changed = True
+        matches.append(list(entry[1]))
+    return matches, cache if changed else None
+
+
+def storeFaceMapping(mesh_obj, mapping):
+    """ Save a mapping returned by matchShapeFaces in the mesh object. Since this changes a document property, it must
+    be called on the main thread. """
+    if mapping is not None and hasattr(mesh_obj, 'FaceMapping'):
+        mesh_obj.FaceMapping = mapping
+
+
+def isMainThread():
+    """ Whether running on the application's main (GUI) thread, or there is no Qt application """
+    app = QtCore.QCoreApplication.instance()
+    return app is None or QtCore.QThread.currentThread() == app.thread()
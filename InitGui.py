@@ -49,8 +49,6 @@ class CfdOFWorkbench(Workbench):
         # must import QtCore in this function,
         # not at the beginning of this file for translation support
         from PySide import QtCore
-        import Fem
-        import FemGui
 
         import _CommandCfdAnalysis
         import _CommandCfdSolverFoam
@@ -25,78 +25,787 @@
 from __future__ import print_function
 import re
 import os
+import sys
+import hashlib
+import marshal
+import tempfile
+import json
+import threading
+import itertools
+import errno
+import time
 
 
 class BracketError(ValueError):
     pass
 
 
+# Matches any of the template markup tokens %( %) %[ %] %{ %} %:
+TOKEN_RE = re.compile(r"%[()\[\]{}:]")
+BRACKETS = {'%(': '%)', '%[': '%]', '%{': '%}'}
+CLOSING_BRACKETS = dict((v, k) for k, v in BRACKETS.items())
+CONDITIONAL = ('%:', None)
+# Matches a whole string of digits
+NUMBER_RE = re.compile(r"[0-9]+\Z")
+
+
+def tokenise(contents):
+    """ Tokenise a template in a single pass into a bracket-matched token stream. The stream is a list
+    whose entries are either plain strings or (bracket, children) tuples, where bracket is one of %(, %[, %{
+    and children is again a token stream. A conditional tag %: at the current level is represented by the
+    CONDITIONAL entry. Closing brackets that have no matching opening bracket are kept as text. """
+    root = []
+    stack = []  # Entries are (bracket, children, position) for each open bracket
+    current = root
+    pos = 0
+    for match in TOKEN_RE.finditer(contents):
+        tok = match.group()
+        n = match.start()
+        if n > pos:
+            current.append(contents[pos:n])
+        pos = match.end()
+        if tok in BRACKETS:
+            stack.append((tok, current, n))
+            current = []
+        elif tok == '%:':
+            current.append(CONDITIONAL)
+        elif stack:
+            bra, parent, start = stack.pop()
+            if CLOSING_BRACKETS[tok] != bra:
+                raise BracketError("Error matching {} ...".format(contents[start:start+40]))
+            parent.append((bra, current))
+            current = parent
+        else:
+            current.append(tok)
+    if stack:
+        start = stack[0][2]
+        raise BracketError("Error matching {} ...".format(contents[start:start+40]))
+    if pos < len(contents):
+        current.append(contents[pos:])
+    return root
+
+
+def splitAtNewline(tokens):
+    """ Split the token stream at the first newline at the current level (not inside brackets), consuming the
+    newline. Returns None for the tail if no newline is found """
+    for i, t in enumerate(tokens):
+        if not isinstance(t, tuple):
+            n = t.find('\n')
+            if n >= 0:
+                return tokens[:i] + [t[:n]], [t[n+1:]] + tokens[i+1:]
+    return tokens, None
+
+
+def stripTokens(tokens):
+    """ Strip leading and trailing whitespace from a token stream """
+    tokens = list(tokens)
+    if tokens and not isinstance(tokens[0], tuple):
+        tokens[0] = tokens[0].lstrip()
+    if tokens and not isinstance(tokens[-1], tuple):
+        tokens[-1] = tokens[-1].rstrip()
+    return [t for t in tokens if t != '']
+
+
+def joinStrings(tokens):
+    """ Merge adjacent plain strings in the token stream """
+    joined = []
+    for t in tokens:
+        if not isinstance(t, tuple) and joined and not isinstance(joined[-1], tuple):
+            joined[-1] += t
+        else:
+            joined.append(t)
+    return joined
+
+
+def toBytes(s):
+    """ Return the string encoded as bytes, e.g. for hashing """
+    return s if isinstance(s, bytes) else s.encode('utf-8')
+
+
+def compileTokens(tokens):
+    """ Compile a token stream into a block of the intermediate representation used for rendering. A block is a
+    (sequence, conditionals) tuple. The sequence is a tuple whose entries are literal strings or the operations
+        ('%(', key_block)                                 - variable substitution
+        ('%[', file_block)                                - file inclusion
+        ('%{', keys_block, body_block, filename_block)    - brace loop, with filename_block None if not present
+    and conditionals is None or a tuple of (keys_block, body_block) pairs, one for each %: tag, whose selected
+    block is appended to the output of the sequence """
+    conditionals = None
+    tags = [i for i, t in enumerate(tokens) if t is CONDITIONAL]
+    if tags:
+        conditionals = []
+        for i, start in enumerate(tags):
+            end = tags[i+1] if i+1 < len(tags) else len(tokens)
+            keys, block = splitAtNewline(tokens[start+1:end])
+            if block is None:
+                raise ValueError("Conditional key list is not terminated by a newline")
+            conditionals.append((compileTokens(keys), compileTokens(block)))
+        conditionals = tuple(conditionals)
+        tokens = tokens[:tags[0]]
+    sequence = []
+    i = 0
+    while i < len(tokens):
+        t = tokens[i]
+        i += 1
+        if not isinstance(t, tuple):
+            sequence.append(t)
+        elif t[0] != '%{':
+            sequence.append((t[0], compileTokens(t[1])))
+        else:
+            # Split into keys and contents
+            keys, body = splitAtNewline(t[1])
+            if body is None:
+                body = []
+            # Extract trailing filename parameter if any, consuming the rest of the line
+            filename, rest = splitAtNewline(tokens[i:])
+            if rest is None:
+                filename = None
+            else:
+                filename = stripTokens(filename)
+                tokens = rest
+                i = 0
+            sequence.append(('%{', compileTokens(keys), compileTokens(body),
+                             compileTokens(filename) if filename else None))
+    return tuple(joinStrings(sequence)), conditionals
+
+
+def compileTemplate(contents):
+    """ Compile template source text into its intermediate representation """
+    return compileTokens(tokenise(contents))
+
+
+_settings_paths = {}
+
+
+def compileSettingsPath(key):
+    """ Split a settings key such as boundaries/inlet/Ux into a tuple of (name, index) pairs, where index is the
+    integer value of the name if it is numeric (for indexing into lists) and None otherwise. The result is memoized
+    since the same keys are looked up repeatedly. """
+    path = _settings_paths.get(key)
+    if path is None:
+        path = tuple((k, int(k) if NUMBER_RE.match(k) else None) for k in key.split('/'))
+        _settings_paths[key] = path
+    return path
+
+
+def renameOver(src, dst):
+    """ Rename a file, replacing the destination if it exists """
+    try:
+        os.rename(src, dst)
+    except OSError:
+        # Windows does not allow renaming over an existing file
+        if not os.path.exists(dst):
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+def makeDirs(path):
+    """ Make sure directory tree exists """
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else:
+            raise
+
+
+# Bump whenever the compiled representation changes so that stale persistent caches are not used
+TEMPLATE_ENGINE_VERSION = 2
+
+
+class TemplateCache(object):
+    """ Cache of the compiled templates in a template directory. Compiled templates are held in memory keyed by
+    file path and validated against the file's modification time and size. If a cache directory is given, they are
+    also persisted to a versioned file there, along with a hash of each template's contents, so that a new session
+    does not need to recompile unchanged templates. Entries for templates which no longer exist are pruned when the
+    file is read, and those for changed templates are replaced when they are recompiled. """
+    def __init__(self, template_path, cache_dir=None):
+        self.template_path = template_path
+        self.cache_file = None
+        if cache_dir is not None:
+            path_hash = hashlib.sha1(toBytes(os.path.abspath(template_path))).hexdigest()[:12]
+            self.cache_file = os.path.join(cache_dir, "{}-{}.py{}{}-v{}.marshal".format(
+                os.path.basename(os.path.normpath(template_path)), path_hash, sys.version_info[0],
+                sys.version_info[1], TEMPLATE_ENGINE_VERSION))
+        self.compiled = {}  # File path -> (file identity, compiled template)
+        self.persistent = self.readCacheFile()  # File path -> (content hash, compiled template)
+        self.modified = False
+        for path in list(self.persistent):
+            if not os.path.isfile(path):
+                del self.persistent[path]
+                self.modified = True
+
+    def readCacheFile(self):
+        """ Read the persistent cache, returning an empty one if there is none or it is corrupt or from another
+        version """
+        if self.cache_file is None:
+            return {}
+        try:
+            with open(self.cache_file, 'rb') as fid:
+                version, templates = marshal.load(fid)
+            if version != TEMPLATE_ENGINE_VERSION or not isinstance(templates, dict):
+                return {}
+            return templates
+        except (EnvironmentError, EOFError, ValueError, TypeError):
+            return {}
+
+    def load(self, rel_file):
+        """ Return the compiled form of the template file, compiling it only if it is not already cached or the
+        file has changed. Raises EnvironmentError if the file cannot be read """
+        path = os.path.normpath(os.path.join(self.template_path, rel_file))
+        st = os.stat(path)
+        file_id = (st.st_mtime, st.st_size)
+        cached = self.compiled.get(path)
+        if cached is not None and cached[0] == file_id:
+            return cached[1]
+        with open(path) as fid:
+            contents = fid.read()
+        content_hash = hashlib.sha1(toBytes(contents)).hexdigest()
+        persisted = self.persistent.get(path)
+        if persisted is not None and persisted[0] == content_hash:
+            template = persisted[1]
+        else:
+            try:
+                template = compileTemplate(contents)
+            except BracketError as err:
+                raise ValueError("Bracket matching error in {}: {}".format(rel_file, err))
+            except ValueError as err:
+                raise ValueError("Error in {}: {}".format(rel_file, err))
+            self.persistent[path] = (content_hash, template)
+            self.modified = True
+        self.compiled[path] = (file_id, template)
+        return template
+
+    def save(self):
+        """ Write any newly compiled templates to the persistent cache. Failure to write (e.g. if the cache
+        directory is read-only) is not an error - the templates are simply recompiled next session """
+        if not self.modified or self.cache_file is None:
+            return
+        cache_dir = os.path.dirname(self.cache_file)
+        tmp_file = None
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            fd, tmp_file = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'wb') as fid:
+                marshal.dump((TEMPLATE_ENGINE_VERSION, self.persistent), fid)
+            os.chmod(tmp_file, 0o644)
+            renameOver(tmp_file, self.cache_file)
+            tmp_file = None
+            self.modified = False
+        except EnvironmentError:
+            pass
+        finally:
+            if tmp_file and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+_template_caches = {}
+
+# Record of the files written to the case by the last build
+MANIFEST_FILE = ".templateManifest"
+MANIFEST_VERSION = 2
+
+
+class FileSystemOutput(object):
+    """ Output backend of TemplateBuilder which writes the case files to a directory """
+    def __init__(self, case_path):
+        self.case_path = case_path
+        self.dirs = set()  # Directories known to exist
+        self.staging_ids = itertools.count()
+
+    def path(self, rel_file):
+        return os.path.join(self.case_path, rel_file)
+
+    def stagingPath(self, rel_file):
+        """ A new path alongside the file, unique so that the same file can be staged more than once at a time, as by
+        nested blocks writing to the same output file """
+        path, name = os.path.split(self.path(rel_file))
+        return os.path.join(path, '.{}.{}.{}.tmp'.format(name, os.getpid(), next(self.staging_ids)))
+
+    def read(self, rel_file):
+        with open(self.path(rel_file)) as f:
+            return f.read()
+
+    def open(self, rel_file, staged=False):
+        """ Open the file for writing text. If staged, the new contents are written to a staging file of their own,
+        which only replaces the file once passed to commit """
+        file_path = self.path(rel_file)
+        path = os.path.dirname(file_path)
+        if path not in self.dirs:
+            makeDirs(path)
+            self.dirs.add(path)
+        return open(self.stagingPath(rel_file) if staged else file_path, 'w')
+
+    def commit(self, rel_file, staged_file):
+        renameOver(staged_file.name, self.path(rel_file))
+
+    def discard(self, rel_file, staged_file):
+        if os.path.exists(staged_file.name):
+            os.remove(staged_file.name)
+
+    def stat(self, rel_file):
+        """ Size and modification time of the file, or None if it does not exist """
+        try:
+            st = os.stat(self.path(rel_file))
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime]
+
+    def remove(self, rel_file):
+        path = self.path(rel_file)
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+class MemoryFile(object):
+    """ Text file opened for writing by MemoryOutput. Once closed, its contents are held in 'data' as bytes. """
+    def __init__(self, on_close=None):
+        self.fragments = []
+        self.on_close = on_close
+        self.data = None
+
+    def write(self, s):
+        self.fragments.append(s)
+
+    def writelines(self, lines):
+        self.fragments.extend(lines)
+
+    def close(self):
+        if self.fragments is not None:
+            self.data = toBytes(''.join(self.fragments))
+            self.fragments = None
+            if self.on_close:
+                self.on_close(self.data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class MemoryOutput(object):
+    """ Output backend of TemplateBuilder which keeps the case files in memory, in the dict 'files' of relative path
+    to contents as bytes. Useful for dry runs, for comparing against an existing case and for tests. A counter of
+    writes stands in for the file modification time. """
+    def __init__(self):
+        self.files = {}
+        self.versions = {}
+        self.write_count = itertools.count(1)
+
+    def store(self, rel_file, data):
+        self.files[rel_file] = data
+        self.versions[rel_file] = next(self.write_count)
+
+    def read(self, rel_file):
+        if rel_file not in self.files:
+            raise IOError(errno.ENOENT, "No such file in memory output", rel_file)
+        return self.files[rel_file].decode('utf-8')
+
+    def open(self, rel_file, staged=False):
+        if staged:
+            return MemoryFile()
+        return MemoryFile(lambda data: self.store(rel_file, data))
+
+    def commit(self, rel_file, staged_file):
+        self.store(rel_file, staged_file.data)
+
+    def discard(self, rel_file, staged_file):
+        pass
+
+    def stat(self, rel_file):
+        if rel_file not in self.files:
+            return None
+        return [len(self.files[rel_file]), self.versions[rel_file]]
+
+    def remove(self, rel_file):
+        self.files.pop(rel_file, None)
+
+    def diff(self, case_path):
+        """ Return the sorted list of files whose contents differ from, or are not present in, the case directory """
+        different = []
+        for rel_file, data in self.files.items():
+            if rel_file == MANIFEST_FILE:
+                continue
+            try:
+                with open(os.path.join(case_path, rel_file), 'rb') as f:
+                    same = f.read() == data
+            except EnvironmentError:
+                same = False
+            if not same:
+                different.append(rel_file)
+        return sorted(different)
+
+    def writeTo(self, case_path):
+        """ Write the files to the case directory """
+        for rel_file, data in self.files.items():
+            path = os.path.join(case_path, rel_file)
+            makeDirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+
+
+def getTemplateCache(template_path, cache_dir=None):
+    """ Return the template cache for the template directory, loading its persistent cache from cache_dir the first
+    time """
+    template_path = os.path.abspath(template_path)
+    cache = _template_caches.get((template_path, cache_dir))
+    if cache is None:
+        cache = TemplateCache(template_path, cache_dir)
+        _template_caches[(template_path, cache_dir)] = cache
+    return cache
+
+
 class TemplateBuilder(object):
     """ Build a case directory from a template directory by substituting
-     values in a python settings dictionary """
+     values in a python settings dictionary. A manifest of the written files and the hashes of their contents is
+     kept in the case directory. In incremental mode, files whose contents have not changed since the last build are
+     left untouched and files that are no longer produced are deleted.
+     The manifest also records the dependencies of each top-level template: the template files it read and the
+     values of the settings it looked up, e.g. 'boundaries/inlet/Ux' for the file 0/U. In incremental mode, a
+     template whose dependencies are all unchanged is not rendered at all.
+     If workers is greater than one, the top-level templates are rendered concurrently by a pool of threads. The
+     settings must not be modified during the build. Output files are written in the same order as for a serial
+     build, and all rendering errors are collected before being raised.
+     In streaming mode, each output file is written fragment by fragment as it is rendered rather than being
+     assembled in memory first, so that memory use does not grow with the size of the output.
+     If profile is set, statistics are recorded for the rendering of each top-level template; see profileReport.
+     Profiling wraps the instrumented methods of this instance only, so it costs nothing when not enabled.
+     The files are written to the case directory unless another output backend, such as a MemoryOutput, is
+     given. If cache_dir is given, compiled templates are kept there between sessions; see TemplateCache. """
     def __init__(self,
                  case_path,
                  template_path,
-                 settings):
+                 settings,
+                 incremental=False,
+                 workers=1,
+                 streaming=False,
+                 profile=False,
+                 output=None,
+                 cache_dir=None):
         if case_path[0] == "~":
             case_path = os.path.expanduser(case_path)
         self.case_path = os.path.abspath(case_path)
+        self.output = output if output is not None else FileSystemOutput(self.case_path)
         self.settings = settings
         self.template_path = template_path
+        self.template_cache = getTemplateCache(template_path, cache_dir)
+        self.incremental = incremental
+        self.streaming = streaming
+        self.old_manifest, self.old_sources = self.readManifest() if incremental else ({}, {})
+        self.manifest = {}
+        self.sources = {}  # Top-level template -> dependencies and outputs
+        self.local = threading.local()
+        self.lookup_cache = {}  # Settings key -> substituted value
+        self.include_cache = {}  # Template file name -> resolved template, see loadInclude
+        self.include_hits = 0
+        self.include_misses = 0
+        self.skipped_templates = []
+        self.profile = None
+        if profile:
+            self.enableProfiling()
+
+        self.buildDir('.', workers)
+        if incremental:
+            self.removeStaleFiles()
+        self.writeManifest()
+        self.template_cache.save()
+
+    def enableProfiling(self):
+        """ Wrap the methods that perform each kind of substitution with ones that count them """
+        self.profile = []
+
+        def counted(method, counter):
+            def wrapper(*args):
+                self.local.stats[counter] += 1
+                return method(*args)
+            return wrapper
+
+        def depthTracked(method):
+            def wrapper(*args):
+                stats = self.local.stats
+                stats['depth'] += 1
+                stats['include_depth'] = max(stats['include_depth'], stats['depth'])
+                try:
+                    return method(*args)
+                finally:
+                    stats['depth'] -= 1
+            return wrapper
+
+        def depthTrackedGenerator(method):
+            def wrapper(*args):
+                stats = self.local.stats
+                stats['depth'] += 1
+                stats['include_depth'] = max(stats['include_depth'], stats['depth'])
+                try:
+                    for f in method(*args):
+                        yield f
+                finally:
+                    stats['depth'] -= 1
+            return wrapper
+
+        def timed(method):
+            def wrapper(rel_file):
+                self.local.stats = {'template': rel_file, 'conditionals': 0, 'braces': 0, 'variables': 0,
+                                    'includes': -1, 'depth': -1, 'include_depth': 0}
+                start = time.time()
+                try:
+                    return method(rel_file)
+                finally:
+                    stats = self.local.stats
+                    del stats['depth']
+                    stats['time'] = time.time() - start
+                    self.profile.append(stats)
+            return wrapper
 
-        self.buildDir('.')
+        self.selectConditional = counted(self.selectConditional, 'conditionals')
+        self.processBrace = counted(self.processBrace, 'braces')
+        self.streamBraces = counted(self.streamBraces, 'braces')
+        self.substituteVariable = counted(self.substituteVariable, 'variables')
+        self.resolveInclude = counted(self.resolveInclude, 'includes')
+        self.buildFile = depthTracked(self.buildFile)
+        self.streamFile = depthTrackedGenerator(self.streamFile)
+        self.renderSource = timed(self.renderSource)
 
-    def buildDir(self, rel_dir):
-        """ Recursively build files in dir (relative to case base) """
+    def profileReport(self):
+        """ Return the profiling statistics as a list of dicts, one for each top-level template rendered, sorted
+        by decreasing render time. Each records the template, the output files produced and their total size, the
+        render time in seconds, the numbers of conditionals, braces, variable substitutions and includes processed,
+        and the maximum depth of nested includes. """
+        report = []
+        for stats in self.profile:
+            source = self.sources.get(stats['template'])
+            outputs = source['outputs'] if source else []
+            report.append(dict(stats, outputs=outputs, size=sum(self.manifest[f][1] for f in outputs)))
+        report.sort(key=lambda r: r['time'], reverse=True)
+        return report
+
+    def writeProfileReport(self, file_name):
+        """ Write the profiling report to a JSON file """
+        with open(file_name, 'w') as f:
+            json.dump(self.profileReport(), f, indent=1, sort_keys=True)
+
+    def profileTable(self):
+        """ Format the profiling report as a text table """
+        rows = [("Template", "Time (ms)", "Cond", "Brace", "Var", "Incl", "Depth", "Size", "Outputs")]
+        for r in self.profileReport():
+            rows.append((r['template'], "{:.2f}".format(r['time']*1000), str(r['conditionals']), str(r['braces']),
+                         str(r['variables']), str(r['includes']), str(r['include_depth']), str(r['size']),
+                         str(len(r['outputs']))))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        lines = ["  ".join(c.ljust(w) if i == 0 else c.rjust(w) for i, (c, w) in enumerate(zip(row, widths)))
+                 for row in rows]
+        return "\n".join(lines) + "\n"
+
+    @property
+    def current_source(self):
+        """ Record of the dependencies and outputs of the top-level template being rendered in this thread """
+        return getattr(self.local, 'source', None)
+
+    @current_source.setter
+    def current_source(self, source):
+        self.local.source = source
+
+    def readManifest(self):
+        """ Read the output files and template dependencies recorded by the last build, returning empty ones if not
+        present, unreadable or from another version """
+        try:
+            manifest = json.loads(self.output.read(MANIFEST_FILE))
+        except (EnvironmentError, ValueError):
+            return {}, {}
+        if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+            return {}, {}
+        return manifest['files'], manifest['sources']
+
+    def writeManifest(self):
+        with self.output.open(MANIFEST_FILE) as f:
+            json.dump({'version': MANIFEST_VERSION, 'files': self.manifest, 'sources': self.sources},
+                      f, indent=0, sort_keys=True)
+
+    def templateIdentity(self, rel_file):
+        """ Modification time and size of a template file, or None if it does not exist """
+        try:
+            st = os.stat(os.path.join(self.template_path, rel_file))
+        except OSError:
+            return None
+        return [st.st_mtime, st.st_size]
+
+    def outputUnchanged(self, rel_file):
+        """ Whether the output file is still as written by the last build """
+        entry = self.old_manifest.get(rel_file)
+        return bool(entry) and self.output.stat(rel_file) == entry[1:]
+
+    def sourceUnchanged(self, rel_file):
+        """ Check whether the dependencies of a top-level template are unchanged since the last build and its
+        output files are intact. If so, its outputs are carried over into the new manifest. """
+        source = self.old_sources.get(rel_file)
+        if not source:
+            return False
+        for template, identity in source['templates'].items():
+            if self.templateIdentity(template) != identity:
+                return False
+        for key, value in source['settings'].items():
+            try:
+                if self.lookupSetting(key) != value:
+                    return False
+            except IndexError:
+                return False
+        for output in source['outputs']:
+            if output in self.manifest or not self.outputUnchanged(output):
+                return False
+        for output in source['outputs']:
+            self.manifest[output] = self.old_manifest[output]
+        self.sources[rel_file] = source
+        return True
+
+    def removeStaleFiles(self):
+        """ Delete files written by the last build which were not produced by this one """
+        for rel_file in self.old_manifest:
+            if rel_file not in self.manifest:
+                self.output.remove(rel_file)
+
+    def buildDir(self, rel_dir, workers=1):
+        """ Build the files in dir (relative to case base) and its subdirectories """
+        pending = []
+        for rel_file in self.findTemplates(rel_dir):
+            if self.incremental and self.sourceUnchanged(rel_file):
+                self.skipped_templates.append(rel_file)
+            else:
+                pending.append(rel_file)
+        if workers > 1 and len(pending) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(workers, len(pending)))
+            try:
+                results = pool.map(self.renderSourceCatchingErrors, pending)
+            finally:
+                pool.close()
+                pool.join()
+            errors = [(rel_file, err) for rel_file, (source, err) in zip(pending, results) if err is not None]
+            if len(errors) == 1:
+                raise errors[0][1]
+            elif errors:
+                raise ValueError("Errors building {} files:\n".format(len(errors)) +
+                                 "\n".join("{}: {}".format(rel_file, err) for rel_file, err in errors))
+            for rel_file, (source, err) in zip(pending, results):
+                self.writeSource(rel_file, source)
+        else:
+            for rel_file in pending:
+                self.writeSource(rel_file, self.renderSource(rel_file))
+
+    def findTemplates(self, rel_dir):
+        """ Recursively list the top-level template files in dir (relative to case base) """
+        templates = []
         full_dir = os.path.join(self.template_path, rel_dir)
         for f in os.listdir(full_dir):
             rel_file = os.path.join(rel_dir, f)
             # Ignore files beginning with underscore so they can be used as includes
             if os.path.basename(rel_file)[0] != '_':
                 if os.path.isdir(os.path.join(self.template_path, rel_dir, f)):
-                    self.buildDir(rel_file)
+                    templates += self.findTemplates(rel_file)
                 else:
-                    contents = self.buildFile(rel_file, [])
-                    # Do not write a blank file - provides a way for optional creation of files
-                    if len(contents):
-                        self.writeToFile(rel_file, contents)
+                    templates.append(os.path.normpath(rel_file))
+        return templates
 
-    def writeToFile(self, rel_file, contents):
-        # Make sure directory tree exists
-        path = os.path.join(self.case_path, os.path.dirname(rel_file))
+    def renderSource(self, rel_file):
+        """ Render a top-level template without writing anything. Returns its record of dependencies, with the
+        output files it produces listed under 'writes'. In streaming mode, the files are written immediately. """
+        self.current_source = {'templates': {}, 'settings': {}, 'outputs': [], 'writes': []}
         try:
-            os.makedirs(path)
-        except OSError as exc:
-            import errno
-            if exc.errno == errno.EEXIST and os.path.isdir(path):
-                pass
+            if self.streaming:
+                # Written as rendered
+                self.writeStream(rel_file, self.streamFile(rel_file, []), skip_empty=True)
             else:
-                raise
+                contents = self.buildFile(rel_file, [])
+                # Do not write a blank file - provides a way for optional creation of files
+                if any(contents):
+                    self.current_source['writes'].append((rel_file, contents))
+            return self.current_source
+        finally:
+            self.current_source = None
+
+    def renderSourceCatchingErrors(self, rel_file):
+        try:
+            return self.renderSource(rel_file), None
+        except Exception as err:
+            return None, err
+
+    def writeSource(self, rel_file, source):
+        """ Write the output files of a rendered top-level template """
+        for filename, contents in source.pop('writes'):
+            self.writeToFile(filename, contents)
+            source['outputs'].append(os.path.normpath(filename))
+        self.sources[rel_file] = source
+
+    def writeToFile(self, rel_file, contents):
+        """ Write contents, given as a string or a list of string fragments, to the file. In incremental mode the
+        file is not rewritten if it is unchanged since the last build. """
+        if not isinstance(contents, list):
+            contents = [contents]
+        rel_file = os.path.normpath(rel_file)
+        content_hash = hashlib.sha1()
+        for f in contents:
+            content_hash.update(toBytes(f))
+        content_hash = content_hash.hexdigest()
+        if self.isUnchanged(rel_file, content_hash):
+            return
         # Write file
-        with open(os.path.join(self.case_path, rel_file), 'w') as ofid:
-            ofid.write(contents)
+        with self.output.open(rel_file) as ofid:
+            ofid.writelines(contents)
+        self.recordOutput(rel_file, content_hash)
 
-    def buildFile(self, rel_file, params):
-        """ Open the specified template file, make replacements, and return as a string """
+    def writeStream(self, rel_file, fragments, skip_empty=False):
+        """ Write string fragments to the file as they are generated. They are staged, replacing the output file
+        once complete, unless the contents turn out to be unchanged (in incremental mode) or blank (if
+        skip_empty). """
+        rel_file = os.path.normpath(rel_file)
+        content_hash = hashlib.sha1()
+        empty = True
+        committed = False
+        ofid = self.output.open(rel_file, staged=True)
         try:
-            fid = open(os.path.join(self.template_path, rel_file))
-        except IOError:
-            # Special cases:
-            # 1. Don't worry if files that end with "None" do not exist
-            if rel_file.endswith("None"):
-                return ""
-            # 2. If a file is not found, try the same file with 'default' after the last underscore
-            rel_file_default = rel_file.rsplit("_", 1)[0] + "_default"
-            try:
-                fid = open(os.path.join(self.template_path, rel_file_default))
-            except IOError:
-                raise IOError("Error reading file {} in template path {}".format(rel_file, self.template_path))
-            finally:
-                rel_file = rel_file_default
-        contents = fid.read()
-        fid.close()
+            with ofid:
+                for f in fragments:
+                    if f:
+                        ofid.write(f)
+                        content_hash.update(toBytes(f))
+                        empty = False
+            content_hash = content_hash.hexdigest()
+            if (empty and skip_empty) or self.isUnchanged(rel_file, content_hash):
+                return
+            self.output.commit(rel_file, ofid)
+            committed = True
+        finally:
+            if not committed:
+                self.output.discard(rel_file, ofid)
+        self.recordOutput(rel_file, content_hash)
+        if self.current_source is not None:
+            self.current_source['outputs'].append(rel_file)
+
+    def isUnchanged(self, rel_file, content_hash):
+        """ In incremental mode, check whether the file need not be rewritten because its contents are the same as
+        in the last build, and if so carry its manifest entry over """
+        # Rewrite if already written during this build or modified by someone else since
+        if self.incremental and rel_file not in self.manifest:
+            old_entry = self.old_manifest.get(rel_file)
+            if old_entry and old_entry[0] == content_hash and self.outputUnchanged(rel_file):
+                self.manifest[rel_file] = old_entry
+                return True
+        return False
+
+    def recordOutput(self, rel_file, content_hash):
+        self.manifest[rel_file] = [content_hash] + self.output.stat(rel_file)
+
+    def buildFile(self, rel_file, params):
+        """ Load the specified compiled template file, make replacements, and return as a list of string
+        fragments """
+        rel_file, template = self.resolveInclude(rel_file)
+        if template is None:
+            return []
         try:
-            contents = self.process(contents, rel_file, params)
+            contents = self.processFragments(template, rel_file, params)
         except BracketError as err:
             raise ValueError("Bracket matching error in {}: {}".format(rel_file, err.message))
         except ValueError as err:
@@ -106,201 +815,272 @@ class TemplateBuilder(object):
             raise
         return contents
 
-    def findAtCurrentLevel(self, string, find_string, start):
-        """ Find the specified string, ignoring anything inside brackets """
-        brackets = {'%(': '%)', '%[': '%]', '%{': '%}'}
-        while True:
-            n = string.find(find_string, start)
-            if n < 0:
-                return None
-            next_bra = [string.find(b, start) for b in brackets.keys()]
-            next_ket = [string.find(b, start) for b in brackets.values()]
-            for i in range(len(next_bra)):
-                if next_bra[i] < 0:
-                    next_bra[i] = len(string)
-            for i in range(len(next_ket)):
-                if next_ket[i] < 0:
-                    next_ket[i] = len(string)
-            if min(next_ket) < min(next_bra):
-                if n <= min(next_ket):
-                    return n
-                else:
-                    return None
-            else:
-                if n <= min(next_bra):
-                    return n
-                else:
-                    end = self.findClosingBracket(string, min(next_bra))
-                    start = end+2
-
-    def findClosingBracket(self, string, start):
-        """ Find the closing bracket corresponding to the one at the start """
-        brackets = {'%(': '%)', '%[': '%]', '%{': '%}'}
-        bra = string[start:start+2]
-        ket = brackets[bra]
-        found = self.findAtCurrentLevel(string, ket, start+2)
-        if found is None:
-            raise BracketError("Error matching {} ...".format(string[start:start+40]))
+    def streamFile(self, rel_file, params):
+        """ Generator equivalent of buildFile, yielding the string fragments as they are produced """
+        rel_file, template = self.resolveInclude(rel_file)
+        if template is None:
+            return
+        try:
+            for f in self.streamBlock(template, rel_file, params):
+                yield f
+        except BracketError as err:
+            raise ValueError("Bracket matching error in {}: {}".format(rel_file, err.message))
+        except ValueError as err:
+            raise ValueError("Error in {}: {}".format(rel_file, err.message))
+        except Exception as err:
+            print("Unexpected error building file {}: {}".format(rel_file, err.message))
+            raise
+
+    def resolveInclude(self, rel_file):
+        """ Return the name of the template file actually used for rel_file and its compiled template, or None if
+        nothing is to be included. The result is cached for the duration of the build. """
+        include = self.include_cache.get(rel_file)
+        if include is None:
+            self.include_misses += 1
+            include = self.loadInclude(rel_file)
+            self.include_cache[rel_file] = include
         else:
-            return found
-
-    def process(self, contents, curr_file, params):
-        """ Processes the contents string at the current level (does not go inside brackets - this is done
-        recursively inside the functions """
-        # print("Before processConditionals {} {}:\n".format(curr_file, params), contents)
-        contents = self.processConditionals(contents, curr_file, params)
-        # print("Before processBraces {} {}:\n".format(curr_file, params), contents)
-        contents = self.processBraces(contents, curr_file, params)
-        # print("Before makeVarSubstitutions {} {}:\n".format(curr_file, params), contents)
-        contents = self.makeVarSubstitutions(contents, curr_file, params)
-        # print("Before makeFileSubstitutions {} {}:\n".format(curr_file, params), contents)
-        contents = self.makeFileSubstitutions(contents, curr_file, params)
-        # print("Final:\n", contents)
-        return contents
+            self.include_hits += 1
+        rel_file, template, dependencies = include
+        if self.current_source is not None:
+            self.current_source['templates'].update(dependencies)
+        return rel_file, template
 
-    def processConditionals(self, contents, curr_file, params):
-        """ Select the relevant conditional block introduced by %:key1 key2 ... by matching the first parameter on 
-        the stack, and process the block with that parameter removed """
-        # Find first conditional
-        start = self.findAtCurrentLevel(contents, "%:", 0)
-        if start is None:
-            return contents
-        pos = start
-        # Loop tags
-        while pos < len(contents):
-            end = self.findAtCurrentLevel(contents, "%:", pos+2)
-            if end is None:
-                end = len(contents)
-            block = contents[pos:end]
-            endOfKey = self.findAtCurrentLevel(block, "\n", 0)
-            matchKeys = block[2:endOfKey]
-            block = block[endOfKey+1:]
+    def loadInclude(self, rel_file):
+        """ Resolve a template file name to the file actually used and load its compiled template. Returns the
+        resolved name, the template (None if nothing is to be included) and the identities of the template files
+        examined, for dependency tracking """
+        dependencies = {os.path.normpath(rel_file): self.templateIdentity(rel_file)}
+        try:
+            template = self.template_cache.load(rel_file)
+        except EnvironmentError:
+            # Special cases:
+            # 1. Don't worry if files that end with "None" do not exist
+            if rel_file.endswith("None"):
+                return rel_file, None, dependencies
+            # 2. If a file is not found, try the same file with 'default' after the last underscore
+            rel_file_default = rel_file.rsplit("_", 1)[0] + "_default"
+            dependencies[os.path.normpath(rel_file_default)] = self.templateIdentity(rel_file_default)
+            try:
+                template = self.template_cache.load(rel_file_default)
+            except EnvironmentError:
+                raise IOError("Error reading file {} in template path {}".format(rel_file, self.template_path))
+            rel_file = rel_file_default
+        return rel_file, template, dependencies
+
+    def process(self, block, curr_file, params):
+        """ Processes a compiled block and returns the resulting string """
+        sequence, conditionals = block
+        if len(sequence) == 1 and not conditionals and not isinstance(sequence[0], tuple):
+            return sequence[0]
+        return ''.join(self.processFragments(block, curr_file, params))
+
+    def processFragments(self, block, curr_file, params):
+        """ Processes a compiled block at the current level (does not go inside brackets - this is done
+        recursively inside the functions). The output is assembled as a list of string fragments, which is only
+        joined once it is needed as a whole, so that each output character is copied only once. """
+        sequence, conditionals = block
+        fragments = list(sequence)
+        if conditionals:
+            fragments.append(self.processConditionals(conditionals, curr_file, params))
+        fragments = self.processBraces(fragments, curr_file, params)
+        fragments = self.makeVarSubstitutions(fragments, curr_file, params)
+        return self.makeFileSubstitutions(fragments, curr_file, params)
+
+    def streamBlock(self, block, curr_file, params):
+        """ Generator equivalent of processFragments. Each fragment at the current level is fully processed and
+        yielded in turn, rather than each kind of substitution being applied to the level as a whole. """
+        sequence, conditionals = block
+        if conditionals:
+            sequence += (('%:', conditionals),)
+        strip_newline = False
+        for f in sequence:
+            if not isinstance(f, tuple):
+                parts = (f,)
+            elif f[0] == '%[':
+                new_file = self.process(f[1], curr_file, params)
+                for s in self.streamFile(new_file, params):
+                    yield s
+                # Drop a newline directly following the include
+                strip_newline = True
+                continue
+            elif f[0] == '%(':
+                parts = (self.substituteVariable(f[1], curr_file, params),)
+            elif f[0] == '%{':
+                parts = self.streamBraces(f, curr_file, params)
+            else:
+                block = self.selectConditional(f[1], curr_file, params)
+                parts = self.streamBlock(block, curr_file, params[1:]) if block else ()
+            for s in parts:
+                if strip_newline and s:
+                    if s[0] == '\n':
+                        s = s[1:]
+                    strip_newline = False
+                yield s
+
+    def selectConditional(self, conditionals, curr_file, params):
+        """ Return the block of the first conditional whose keys match the first parameter, or None """
+        for keys_block, block in conditionals:
             # Process matchKeys
-            matchKeys = self.process(matchKeys, curr_file, params)
+            matchKeys = self.process(keys_block, curr_file, params)
             matchKeys = matchKeys.split()
             if params[0] in matchKeys or "default" in matchKeys:
-                block = self.process(block, curr_file, params[1:])  # Remove first (matching) param inside block
-                return contents[:start]+block
-            pos = end
-        return contents[:start]
+                return block
+        return None
 
-    def processBraces(self, contents, curr_file, params):
+    def processConditionals(self, conditionals, curr_file, params):
+        """ Select the relevant conditional block introduced by %:key1 key2 ... by matching the first parameter on 
+        the stack, and process the block with that parameter removed """
+        block = self.selectConditional(conditionals, curr_file, params)
+        if block:
+            # Remove first (matching) param inside block
+            return self.processFragments(block, curr_file, params[1:])
+        return []
+
+    def processBraces(self, fragments, curr_file, params):
         """ Process brace substitutions. Format:
         %{val1 [val2]\n
         content
         %} [output-file]\n
         pushes values onto the parameter stack, one by one and repeats content for each """
-        while True:
-            start = contents.find("%{")
-            if start < 0:
-                break
-            end = self.findClosingBracket(contents, start)
-            replace = contents[start+2:end]
-            # Split into keys and contents
-            delim = self.findAtCurrentLevel(replace, '\n', 0)
-            if delim is None:
-                delim = len(replace)
-            keys = replace[:delim]
-            # Make any replacements in keys
-            keys = self.process(keys, curr_file, params)
-            keys = keys.split(' ')
-            replace = replace[delim+1:]
-            # Extract trailing filename parameter if any
-            trailing_nl = self.findAtCurrentLevel(contents, '\n', end+2)
-            filename_param = None
-            if trailing_nl is not None:
-                filename_param = contents[end+2:trailing_nl].strip()
-            # Loop the content passing values
-            replacement = ""
-            for v in keys:
-                filename = None
-                if filename_param:
-                    # Process filename with parameter
-                    filename = self.process(filename_param, curr_file, [v] + params)
-                    if not filename:
-                        raise ValueError("File name parameter " + filename_param + "evaluates to nothing")
-                processed = self.process(replace, filename if filename else curr_file, [v] + params)
-                if filename:
-                    self.writeToFile(filename, processed)
+        processed = []
+        for f in fragments:
+            if not isinstance(f, tuple) or f[0] != '%{':
+                processed.append(f)
+            else:
+                processed.append(self.processBrace(f, curr_file, params))
+        return processed
+
+    def processBrace(self, brace, curr_file, params):
+        """ Process a single brace block, returning the list of fragments replacing it """
+        _, keys_block, body_block, filename_block = brace
+        # Make any replacements in keys
+        keys = self.process(keys_block, curr_file, params)
+        keys = keys.split(' ')
+        # Loop the content passing values
+        replacement = []
+        for v in keys:
+            filename = None
+            if filename_block:
+                filename = self.braceFileName(filename_block, curr_file, [v] + params)
+            contents = self.processFragments(body_block, filename if filename else curr_file, [v] + params)
+            if filename:
+                if self.current_source is not None:
+                    # Deferred until the top-level template has been rendered
+                    self.current_source['writes'].append((filename, contents))
                 else:
-                    replacement += processed
-            replace = replacement
-            afterEnd = (trailing_nl+1 if trailing_nl else end+2)
-            contents = contents[:start] + replace + contents[afterEnd:]
-        return contents
+                    self.writeToFile(filename, contents)
+            else:
+                replacement.extend(contents)
+        return replacement
+
+    def streamBraces(self, brace, curr_file, params):
+        """ Generator equivalent of processBraces for a single brace block. Content for a filename parameter is
+        streamed to that file. """
+        _, keys_block, body_block, filename_block = brace
+        keys = self.process(keys_block, curr_file, params)
+        for v in keys.split(' '):
+            if filename_block:
+                filename = self.braceFileName(filename_block, curr_file, [v] + params)
+                self.writeStream(filename, self.streamBlock(body_block, filename, [v] + params))
+            else:
+                for s in self.streamBlock(body_block, curr_file, [v] + params):
+                    yield s
 
-    def makeVarSubstitutions(self, contents, curr_file, params):
+    def braceFileName(self, filename_block, curr_file, params):
+        """ Process filename with parameter """
+        filename = self.process(filename_block, curr_file, params)
+        if not filename:
+            raise ValueError("File name parameter evaluates to nothing")
+        return filename
+
+    def makeVarSubstitutions(self, fragments, curr_file, params):
         """ Perform variable substitutions. Format:
         %(key/in/settings/dict%) key/in/settings/dict is the name of a variable 
         in the settings dict, with subdicts separated by backslashes, or a numeric value on the
         parameter stack. If 
         key/in/settings/dict specifies a dictionary or a list, its keys/values 
         are outputted separated by white space """
-        while True:
-            start = contents.find("%(")
-            if start < 0:
-                break
-            end = self.findClosingBracket(contents, start)
-            key = contents[start+2:end]
-            # Make any replacements
-            key = self.process(key, curr_file, params)
-            # Special case - if key is a number, treat as positional parameter
-            match = re.match("[0-9]+", key)
-            if match and match.span() == (0, len(key)):
-                try:
-                    replace = str(params[int(key)])
-                except IndexError:
-                    raise ValueError("Index " + key + " of stack variables is out of range")
-            # Otherwise, navigate the settings dict for the key
-            else:
-                keys = key.split('/')
-                dic = self.settings
-                for k in keys:
-                    # Special key to list contents
-                    if k == "LIST":
-                        print("Contents:")
-                        print(dic)
-                    if isinstance(dic, dict) and (k in dic):
-                        dic = dic[k]
-                    elif isinstance(dic, list):
-                        # Lists must be indexed with an integer
-                        match = re.match("[0-9]+", k)
-                        if match and match.span() == (0, len(k)):
-                            dic = dic[int(k)]
-                        else:
-                            dic = "None"
-                    else:
-                        # Not found. Replace with "None"
-                        dic = "None"
-                if isinstance(dic, dict) or isinstance(dic, tuple):
-                    # Dictionary type - print keys
-                    # Tuple type - print values
-                    replacement = ""
-                    for k in dic:
-                        replacement += str(k) + " "
-                    replace = replacement[:-1]  # Trim trailing space
-                elif isinstance(dic, list):
-                    # List type - print indices
-                    replacement = ""
-                    for i in range(len(dic)):
-                        replacement += str(i) + " "
-                    replace = replacement[:-1]  # Trim trailing space
+        processed = []
+        for f in fragments:
+            if not isinstance(f, tuple) or f[0] != '%(':
+                processed.append(f)
+                continue
+            processed.append(self.substituteVariable(f[1], curr_file, params))
+        return processed
+
+    def substituteVariable(self, key_block, curr_file, params):
+        # Make any replacements
+        key = self.process(key_block, curr_file, params)
+        # Special case - if key is a number, treat as positional parameter
+        if NUMBER_RE.match(key):
+            try:
+                return str(params[int(key)])
+            except IndexError:
+                raise ValueError("Index " + key + " of stack variables is out of range")
+        # Otherwise, navigate the settings dict for the key
+        replace = self.lookupSetting(key)
+        if self.current_source is not None:
+            self.current_source['settings'][key] = replace
+        return replace
+
+    def lookupSetting(self, key):
+        """ Look up the key, with subdicts separated by forward slashes, in the settings dict and return its value
+        as a string for substitution. Since the settings do not change during the build, the result is cached. """
+        value = self.lookup_cache.get(key)
+        if value is None:
+            value = self.resolveSetting(key)
+            self.lookup_cache[key] = value
+        return value
+
+    def resolveSetting(self, key):
+        dic = self.settings
+        for k, index in compileSettingsPath(key):
+            # Special key to list contents
+            if k == "LIST":
+                print("Contents:")
+                print(dic)
+            if isinstance(dic, dict) and (k in dic):
+                dic = dic[k]
+            elif isinstance(dic, list):
+                # Lists must be indexed with an integer
+                if index is not None:
+                    dic = dic[index]
                 else:
-                    replace = str(dic)
-            contents = contents[:start] + replace + contents[end+2:]
-        return contents
+                    dic = "None"
+            else:
+                # Not found. Replace with "None"
+                dic = "None"
+        if isinstance(dic, dict) or isinstance(dic, tuple):
+            # Dictionary type - print keys
+            # Tuple type - print values
+            return " ".join(str(k) for k in dic)
+        elif isinstance(dic, list):
+            # List type - print indices
+            return " ".join(str(i) for i in range(len(dic)))
+        else:
+            return str(dic)
 
-    def makeFileSubstitutions(self, contents, cur_file, params):
-        # Perform file substitutions
-        while True:
-            start = contents.find("%[")
-            if start < 0:
-                break
-            end = self.findClosingBracket(contents, start)
-            new_file = contents[start+2:end]
-            if cur_file == new_file:
-                ValueError("File cannot include itself: " + cur_file)
-            replacement = self.buildFile(new_file, params)
-            afterEnd = (end+3 if contents[end+2:end+3] == '\n' else end+2)
-            contents = contents[:start] + replacement + contents[afterEnd:]
-        return contents
+    def makeFileSubstitutions(self, fragments, cur_file, params):
+        """ Perform file substitutions, flattening the fragments into a single list. A newline directly following
+        the closing bracket of the include is dropped. """
+        processed = []
+        strip_newline = False
+        for f in fragments:
+            if isinstance(f, tuple):
+                # Must be an include since braces and variables have already been substituted
+                new_file = self.process(f[1], cur_file, params)
+                if cur_file == new_file:
+                    ValueError("File cannot include itself: " + cur_file)
+                processed.extend(self.buildFile(new_file, params))
+                strip_newline = True
+                continue
+            if not isinstance(f, list):
+                f = [f]
+            for s in f:
+                if strip_newline and s:
+                    if s[0] == '\n':
+                        s = s[1:]
+                    strip_newline = False
+                processed.append(s)
+        return processed
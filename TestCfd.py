@@ -35,11 +35,17 @@ import CfdMeshGmsh
 import CfdFluidBoundary
 import CfdTools
 import CfdCaseWriterFoam
+import TemplateBuilder
 
+import collections
 import tempfile
 import unittest
 import os
 import shutil
+import time
+import json
+import platform
+import subprocess
 
 __title__ = "CFD unit test"
 __author__ = "AB, JH, OO"
@@ -199,6 +205,24 @@ class BlockTest(unittest.TestCase):
         self.writer = CfdCaseWriterFoam.CfdCaseWriterFoam(self.analysis)
         self.writer.write_case()
 
+    def caseFileIds(self):
+        """ Inode of each file in the case, which changes when the file is rewritten """
+        case_dir = os.path.join(self.solver_object.WorkingDir, self.solver_object.InputCaseName)
+        ids = {}
+        for root, dirs, files in os.walk(case_dir):
+            for f in files:
+                path = os.path.join(root, f)
+                ids[os.path.relpath(path, case_dir).replace(os.path.sep, '/')] = os.stat(path).st_ino
+        return ids
+
+    def updateCaseFiles(self):
+        """ Update the case, returning the files which were rewritten """
+        old_ids = self.caseFileIds()
+        CfdCaseWriterFoam.CfdCaseWriterFoam(self.analysis).write_case(updating=True)
+        new_ids = self.caseFileIds()
+        self.assertEqual(sorted(new_ids), sorted(old_ids))
+        return set(f for f in new_ids if new_ids[f] != old_ids[f]) - {TemplateBuilder.MANIFEST_FILE}
+
     def test_new_analysis(self):
         fccPrint('--------------- Start of CFD tests ---------------')
         fccPrint('Checking CFD {} analysis ...'.format(self.__class__.__doc_name))
@@ -254,6 +278,18 @@ class BlockTest(unittest.TestCase):
         self.writeCaseFiles()
         self.assertTrue(self.writer, "CfdTest of writer failed")
 
+        fccPrint('Updating unchanged {} case ...'.format(self.__class__.__doc_name))
+        self.assertEqual(self.updateCaseFiles(), set())
+
+        fccPrint('Updating {} case with changed inlet velocity ...'.format(self.__class__.__doc_name))
+        bc_set = self.inlet_boundary.BoundarySettings
+        bc_set['Ux'] = 2
+        self.inlet_boundary.BoundarySettings = bc_set
+        changed = self.updateCaseFiles()
+        self.assertIn('0/U', changed)
+        self.assertNotIn('system/controlDict', changed)
+        self.assertFalse([f for f in changed if f.startswith('constant/polyMesh.org/')], "Unchanged mesh rewritten")
+
         # ref_dir = os.path.join(test_file_dir, "cases", self.__class__.__doc_name)
         # case_dir = os.path.join(self.solver_object.WorkingDir, self.solver_object.InputCaseName)
         #
@@ -278,6 +314,672 @@ class BlockTest(unittest.TestCase):
         pass
 
 
+class TemplateBuilderTest(unittest.TestCase):
+    """ Tests of the case template engine which do not require a document """
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        self.case_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+        shutil.rmtree(self.case_dir)
+
+    def writeTemplate(self, rel_file, contents):
+        with open(os.path.join(self.template_dir, rel_file), 'w') as f:
+            f.write(contents)
+
+    def readCaseFile(self, rel_file):
+        with open(os.path.join(self.case_dir, rel_file)) as f:
+            return f.read()
+
+    def test_substitutions(self):
+        self.writeTemplate('_include_default', 'included %(0%)\n')
+        self.writeTemplate('dict', '%{%(boundaries%)\n'
+                                   '%{%(boundaries/%(0%)/Type%)\n'
+                                   '%:wall\n'
+                                   'wall %(0%) %(boundaries/%(0%)/Values%)\n'
+                                   '%:default\n'
+                                   '%[_include_%(0%)%]\n'
+                                   '%}\n'
+                                   '%}\n'
+                                   '%{%(boundaries%)\n'
+                                   'file %(0%)\n'
+                                   '%} %(0%)\n')
+        settings = {'boundaries': {'a': {'Type': 'wall', 'Values': (1, 2)}}}
+        TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, settings)
+        self.assertEqual(self.readCaseFile('dict'), 'wall a 1 2\n')
+        self.assertEqual(self.readCaseFile('a'), 'file a\n')
+
+        settings = {'boundaries': {'b': {'Type': 'inlet'}}}
+        TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, settings)
+        self.assertEqual(self.readCaseFile('dict'), 'included b\n')
+
+    def test_incremental_build(self):
+        self.writeTemplate('a', '%(a%)\n')
+        self.writeTemplate('b', '%(b%)\n')
+        TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, {'a': 1, 'b': 1})
+        mtime_a = os.path.getmtime(os.path.join(self.case_dir, 'a'))
+        os.remove(os.path.join(self.template_dir, 'b'))
+        TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, {'a': 1}, incremental=True)
+        # Unchanged file must be left untouched, and a file that is no longer produced must be removed
+        self.assertEqual(os.path.getmtime(os.path.join(self.case_dir, 'a')), mtime_a)
+        self.assertFalse(os.path.exists(os.path.join(self.case_dir, 'b')))
+        TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, {'a': 2}, incremental=True)
+        self.assertEqual(self.readCaseFile('a'), '2\n')
+
+    def test_dependency_tracking(self):
+        self.writeTemplate('_include', '%(b/y%)\n')
+        self.writeTemplate('a', '%(a%)\n')
+        self.writeTemplate('b', '%[_include%]\n')
+        settings = {'a': 1, 'b': {'x': 1, 'y': 2}}
+        TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, settings)
+        settings['a'] = 3
+        settings['b']['x'] = 4
+        builder = TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, settings, incremental=True)
+        self.assertEqual(builder.skipped_templates, ['b'])
+        self.assertEqual(self.readCaseFile('a'), '3\n')
+        settings['b']['y'] = 5
+        builder = TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, settings, incremental=True)
+        self.assertEqual(builder.skipped_templates, ['a'])
+        self.assertEqual(self.readCaseFile('b'), '5\n')
+
+    def test_include_cache(self):
+        self.writeTemplate('_boundary_default', 'default %(0%)\n')
+        self.writeTemplate('dict', '%{a b c\n%[_boundary_%(0%)%]%[_extraNone%]%}\n')
+        builder = TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, {})
+        self.assertEqual(self.readCaseFile('dict'), 'default a\ndefault b\ndefault c\n')
+        # dict and each distinct include name are loaded once
+        self.assertEqual(builder.include_misses, 5)
+        self.assertEqual(builder.include_hits, 2)
+
+    def test_persistent_template_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.writeTemplate('a', 'a %(x%)\n')
+        self.writeTemplate('b', 'b\n')
+        TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, {'x': 1}, cache_dir=cache_dir)
+        self.assertEqual(sorted(os.listdir(self.template_dir)), ['a', 'b'])
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        def cachedTemplates():
+            """ Content hash of each template in the persistent cache, as read in a new session """
+            cache = TemplateBuilder.TemplateCache(self.template_dir, cache_dir)
+            return dict((os.path.basename(path), entry[0]) for path, entry in cache.persistent.items())
+        cached = cachedTemplates()
+        self.assertEqual(sorted(cached), ['a', 'b'])
+        # Removed templates are pruned, and changed ones replaced
+        os.remove(os.path.join(self.template_dir, 'b'))
+        self.assertEqual(cachedTemplates(), {'a': cached['a']})
+        self.writeTemplate('a', 'changed a %(x%)\n')
+        TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, {'x': 1}, cache_dir=cache_dir)
+        self.assertEqual(self.readCaseFile('a'), 'changed a 1\n')
+        self.assertEqual(list(cachedTemplates()), ['a'])
+        self.assertNotEqual(cachedTemplates()['a'], cached['a'])
+
+    def test_streaming_build(self):
+        self.writeTemplate('_inc', 'included %(0%)\n')
+        self.writeTemplate('dict', 'start\n%{%(names%)\n%[_inc%]\nentry %(0%);\n%}\n%{a b\nfile %(0%)\n%} out_%(0%)\n'
+                                   'end\n')
+        settings = {'names': ['n' + str(i) for i in range(1000)]}
+        TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, settings)
+        expected = dict((f, self.readCaseFile(f)) for f in ['dict', 'out_a', 'out_b'])
+        shutil.rmtree(self.case_dir)
+        TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, settings, streaming=True)
+        self.assertEqual(sorted(os.listdir(self.case_dir)), ['.templateManifest', 'dict', 'out_a', 'out_b'])
+        for f in expected:
+            self.assertEqual(self.readCaseFile(f), expected[f])
+
+    def test_streaming_nested_outputs(self):
+        # Nested blocks writing the same output file are each staged separately; the outermost is written last
+        self.writeTemplate('dict', '%{%(l%)\n%{%(b%)\n%{%(b%)\n;%{p\n \n%}\n;%} f_%(0%)\n x y\n%} f_%(0%)\n%} \n')
+        settings = {'l': ['a'], 'b': ['c']}
+        TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, settings)
+        expected = self.readCaseFile('f_0')
+        shutil.rmtree(self.case_dir)
+        TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, settings, streaming=True)
+        self.assertEqual(sorted(os.listdir(self.case_dir)), ['.templateManifest', 'f_0'])
+        self.assertEqual(self.readCaseFile('f_0'), expected)
+
+    def test_profiling(self):
+        self.writeTemplate('_inc', '%:a\n%(x%)\n%:default\nnone\n')
+        self.writeTemplate('dict', '%{a b\n%[_inc%]%}\n')
+        builder = TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, {'x': 1}, profile=True)
+        report = builder.profileReport()
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]['template'], 'dict')
+        self.assertEqual(report[0]['outputs'], ['dict'])
+        self.assertEqual(report[0]['size'], len('1\nnone\n'))
+        self.assertEqual([report[0][k] for k in ['braces', 'includes', 'conditionals', 'variables', 'include_depth']],
+                         [1, 2, 2, 1, 1])
+        self.assertIn('dict', builder.profileTable())
+        # Not instrumented unless enabled
+        builder = TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, {'x': 1})
+        self.assertNotIn('substituteVariable', vars(builder))
+
+    def test_memory_output(self):
+        self.writeTemplate('a', '%(a%)\n')
+        self.writeTemplate('b', '%{x y\n%(0%)\n%} sub/%(0%)\n')
+        output = TemplateBuilder.MemoryOutput()
+        TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, {'a': 1}, output=output)
+        self.assertEqual(os.listdir(self.case_dir), [])
+        self.assertEqual(output.files[os.path.join('sub', 'y')], b'y\n')
+        self.assertEqual(output.diff(self.case_dir), ['a', os.path.join('sub', 'x'), os.path.join('sub', 'y')])
+        TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, {'a': 2})
+        self.assertEqual(output.diff(self.case_dir), ['a'])
+
+    def test_parallel_build(self):
+        for i in range(8):
+            self.writeTemplate('f' + str(i), '%{%(keys%)\n%(0%) ' + str(i) + '\n%} out_%(0%)_' + str(i) + '\n')
+        TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, {'keys': {'a': 1, 'b': 2}}, workers=4)
+        self.assertEqual(self.readCaseFile('out_b_7'), 'b 7\n')
+        self.assertEqual(len(os.listdir(self.case_dir)), 17)
+        # Errors in several files are reported together
+        self.writeTemplate('g1', '%(0%)')
+        self.writeTemplate('g2', '%(1%)')
+        with self.assertRaises(ValueError) as cm:
+            TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, {'keys': {}}, workers=4)
+        self.assertIn('g1', str(cm.exception))
+        self.assertIn('g2', str(cm.exception))
+
+    def test_substitution_scaling(self):
+        """ Benchmark: rendering time must scale linearly with the number of variable substitutions """
+        settings = {'a': 'value'}
+        times = []
+        for n in [2000, 16000]:
+            self.writeTemplate('dict', 'entry %(a%);\n'*n)
+            TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, settings)  # Compile and warm up
+            best = None
+            for i in range(3):
+                start = time.time()
+                TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, settings)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            fccPrint('{} substitutions rendered in {:.4f} s'.format(n, best))
+            times.append(best)
+            self.assertEqual(self.readCaseFile('dict'), 'entry value;\n'*n)
+        # Linear scaling gives a ratio of 8; allow for timing noise but fail on quadratic behaviour (ratio 64)
+        self.assertLess(times[1], 24*times[0])
+
+    def test_settings_lookup_benchmark(self):
+        """ Benchmark: deep settings lookups repeated in a loop over 2000 boundaries are only resolved once """
+        n = 2000
+        settings = {'boundaries': dict(('patch' + str(i), {'BoundaryType': 'wall', 'Ux': [0, i]}) for i in range(n)),
+                    'solver': {'schemes': {'div': 'Gauss linear'}}}
+        self.writeTemplate('dict', '%{%(boundaries%)\n%(0%) %(boundaries/%(0%)/BoundaryType%) '
+                                   '%(boundaries/%(0%)/Ux/1%) %(solver/schemes/div%);\n%}\n')
+        start = time.time()
+        builder = TemplateBuilder.TemplateBuilder(self.case_dir, self.template_dir, settings)
+        fccPrint('{} boundaries rendered in {:.4f} s'.format(n, time.time() - start))
+        self.assertIn('patch1999 wall 1999 Gauss linear;\n', self.readCaseFile('dict'))
+        # boundaries, solver/schemes/div and two entries per boundary
+        self.assertEqual(len(builder.lookup_cache), 2 + 2*n)
+
+
+class TemplateOutputTest(unittest.TestCase):
+    """ Regression test of the case and mesh templates: rendering them with representative settings must reproduce
+    the reference output in testFiles/cases/templates exactly """
+    BOUNDARY_TYPES = [('wall', 'fixed'), ('wall', 'slip'), ('wall', 'translating'), ('wall', 'partialSlip'),
+                      ('wall', 'rough'), ('inlet', 'uniformVelocity'), ('inlet', 'volumetricFlowRate'),
+                      ('inlet', 'massFlowRate'), ('inlet', 'totalPressure'), ('inlet', 'staticPressure'),
+                      ('outlet', 'staticPressure'), ('outlet', 'uniformVelocity'), ('outlet', 'outFlow'),
+                      ('open', 'totalPressure'), ('constraint', 'symmetry'), ('constraint', 'empty'),
+                      ('baffle', 'porousBaffle')]
+
+    def setUp(self):
+        self.case_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.case_dir)
+
+    def caseSettings(self, solver, time_model, turbulence, turbulence_model, mesh_type, parallel):
+        boundaries = {}
+        for i, (bc_type, bc_subtype) in enumerate(self.BOUNDARY_TYPES):
+            boundaries['bc{}_{}'.format(i, bc_type)] = {
+                'BoundaryType': bc_type, 'BoundarySubtype': bc_subtype, 'VelocityIsCartesian': True,
+                'Ux': 1.5, 'Uy': 0.0, 'Uz': -2.25, 'VelocityMag': 0.0, 'DirectionFace': '', 'ReverseNormal': False,
+                'Pressure': 101.0, 'KinematicPressure': 0.1, 'SlipRatio': 0.5, 'VolFlowRate': 0.01,
+                'MassFlowRate': 0.2, 'PorousBaffleMethod': 0, 'PressureDropCoeff': 0.3, 'ScreenWireDiameter': 0.0,
+                'ScreenSpacing': 0.0, 'TurbulenceInletSpecification': 'intensityAndLengthScale',
+                'ThermalBoundaryType': '', 'TurbulentKineticEnergy': 0.01, 'SpecificDissipationRate': 1,
+                'TurbulenceIntensity': 0.1, 'TurbulenceLengthScale': 0.1, 'alphas': {'water': 0.3, 'air': 0.7}}
+        fluids = [{'Name': 'water', 'Density': 1000.0, 'DynamicViscosity': 0.001, 'KinematicViscosity': 1e-6},
+                  {'Name': 'air', 'Density': 1.2, 'DynamicViscosity': 1.8e-5, 'KinematicViscosity': 1.5e-5}]
+        return {
+            'physics': {'Time': time_model, 'Flow': 'Incompressible', 'Turbulence': turbulence, 'Thermal': None,
+                        'TurbulenceModel': turbulence_model},
+            'fluidProperties': fluids if solver == 'interFoam' else fluids[:1],
+            'initialValues': {'PotentialFoam': True, 'Ux': 0, 'Uy': 1.0, 'Uz': 0, 'Pressure': 0,
+                              'KinematicPressure': 0, 'UseInletTurbulenceValues': False, 'Inlet': '', 'k': 0.01,
+                              'omega': 1, 'alphas': {'water': 1.0, 'air': 0.0}},
+            'boundaries': boundaries,
+            'bafflesPresent': True,
+            'porousZones': {'pz1': {'PartNameList': ('a', 'b'), 'D': (1, 2, 3), 'F': (4, 5, 6), 'e1': (1, 0, 0),
+                                    'e3': (0, 0, 1)}},
+            'porousZonesPresent': True,
+            'initialisationZones': {'iz1': {'PartNameList': ('c',), 'Ux': 1, 'Uy': 2, 'Uz': 3, 'Pressure': 4,
+                                            'alphas': {'water': 0.5, 'air': 0.5}}},
+            'initialisationZonesPresent': True,
+            'zones': {'z1': {'PartNameList': ('p1', 'p2')}},
+            'zonesPresent': True,
+            'meshType': mesh_type,
+            'solver': {'solverName': solver, 'parallel': parallel, 'parallelCores': 4, 'endTime': 100.0,
+                       'timeStep': 0.01, 'writeInterval': 10.0, 'convergenceCriteria': 1e-4,
+                       'inputCaseName': 'case'},
+            'system': {'FoamRuntime': 'Posix', 'CasePath': '/tmp/case', 'TranslatedCasePath': '/tmp/case',
+                       'FoamPath': '/opt/openfoam4', 'TranslatedFoamPath': '/opt/openfoam4'},
+            'createPatchesFromSnappyBaffles': True,
+            'createPatches': dict(('patch{}'.format(i), {'PatchNamesList': tuple('face{}'.format(j)
+                                                                                  for j in range(i, 20, 7)),
+                                                          'PatchType': 'wall'}) for i in range(7)),
+            'createPatchesSnappyBaffles': {'baf': {'PatchNamesList': ('x', 'y'),
+                                                   'PatchNamesListSlave': ('x_slave', 'y_slave')}}}
+
+    def meshSettings(self, mesh_utility, parallel):
+        return {
+            'Name': 'Part', 'MeshPath': '/tmp/meshCase', 'FoamRuntime': 'Posix', 'TranslatedFoamPath': '/opt/openfoam4',
+            'MeshUtility': mesh_utility, 'MeshRegionPresent': True,
+            'CfSettings': {'ClMax': 0.01, 'BoundaryLayerPresent': True,
+                           'MeshRegions': {'r1': {'RelativeLength': 0.1, 'RefinementThickness': 0.01}},
+                           'BoundaryLayers': {'face1': {'NumberLayers': 3, 'ExpansionRatio': 1.1,
+                                                        'FirstLayerHeight': 0.001}}},
+            'SnappySettings': {'MeshRegions': {'r1': {'RegionName': ('r1', 'r1b'), 'RefinementLevel': 2,
+                                                      'EdgeRefinementLevel': 1, 'Baffle': False}},
+                               'BlockMesh': {'xMin': 0, 'xMax': 1, 'yMin': 0, 'yMax': 1, 'zMin': 0, 'zMax': 1,
+                                             'cellsX': 10, 'cellsY': 10, 'cellsZ': 10},
+                               'ShapeFaceNames': tuple('face{}'.format(i) for i in range(30)),
+                               'EdgeRefinementLevel': 1, 'PointInMesh': {'x': 0.1, 'y': 0.2, 'z': 0.3},
+                               'CellsBetweenLevels': 3, 'ParallelMesh': parallel, 'NumberCores': 4}}
+
+    def ordered(self, settings):
+        """ Copy of the settings with all dicts ordered by key, so that the order in which the templates iterate over
+        them is the same in Python 2 and 3 """
+        if isinstance(settings, dict):
+            return collections.OrderedDict((k, self.ordered(settings[k])) for k in sorted(settings))
+        return settings
+
+    def checkOutput(self, template_dir, settings, reference):
+        TemplateBuilder.TemplateBuilder(self.case_dir, os.path.join(home_path, 'data', template_dir),
+                                        self.ordered(settings))
+        reference_dir = os.path.join(test_file_dir, 'cases', 'templates', reference)
+
+        def readTree(root):
+            files = {}
+            for path, dirs, names in os.walk(root):
+                for name in names:
+                    if name != TemplateBuilder.MANIFEST_FILE:
+                        with open(os.path.join(path, name), 'rb') as f:
+                            files[os.path.relpath(os.path.join(path, name), root)] = f.read().replace(b'\r\n', b'\n')
+            return files
+        expected = readTree(reference_dir)
+        output = readTree(self.case_dir)
+        self.assertEqual(sorted(output), sorted(expected))
+        for rel_file in expected:
+            self.assertEqual(output[rel_file], expected[rel_file], "{} differs from the reference".format(rel_file))
+
+    def test_steady_cartesian_case(self):
+        self.checkOutput('defaults', self.caseSettings('simpleFoam', 'Steady', 'Laminar', None, 'CfdMeshCart', False),
+                         'steadyCartesian')
+
+    def test_transient_parallel_case(self):
+        self.checkOutput('defaults', self.caseSettings('pimpleFoam', 'Transient', 'RANS', 'kOmegaSST', 'FemMeshGmsh',
+                                                       True), 'transientParallel')
+
+    def test_multiphase_case(self):
+        self.checkOutput('defaults', self.caseSettings('interFoam', 'Transient', 'Laminar', None, 'CfdMeshCart',
+                                                       False), 'multiphase')
+
+    def test_cfmesh_case(self):
+        self.checkOutput('defaultsMesh', self.meshSettings('cfMesh', False), 'cfMesh')
+
+    def test_snappy_case(self):
+        self.checkOutput('defaultsMesh', self.meshSettings('snappyHexMesh', True), 'snappyHexMesh')
+
+
+class MeshCacheTest(unittest.TestCase):
+    """ Tests of the store of converted meshes """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def makeMesh(self, name, contents):
+        mesh_dir = os.path.join(self.temp_dir, name, 'polyMesh')
+        os.makedirs(mesh_dir)
+        for f in ['points', 'faces']:
+            with open(os.path.join(mesh_dir, f), 'w') as fid:
+                fid.write(contents*50)
+        return mesh_dir
+
+    def test_store_fetch_and_evict(self):
+        cache = CfdTools.MeshCache(os.path.join(self.temp_dir, 'cache'), max_size=250)
+        keys = [cache.key('mesh', i) for i in range(3)]
+        cache.store(keys[0], self.makeMesh('a', 'a'))
+        cache.store(keys[1], self.makeMesh('b', 'b'))
+        # Make the first entry the older, then use it so that the second becomes the least recently used
+        os.utime(os.path.join(cache.cache_dir, keys[0]), (1000, 1000))
+        os.utime(os.path.join(cache.cache_dir, keys[1]), (2000, 2000))
+        fetched = os.path.join(self.temp_dir, 'fetched', 'polyMesh')
+        self.assertTrue(cache.fetch(keys[0], fetched))
+        cache.store(keys[2], self.makeMesh('c', 'c'))
+        self.assertEqual(sorted(os.listdir(cache.cache_dir)), sorted([keys[0], keys[2]]))
+
+        self.assertFalse(cache.fetch(keys[1], fetched))
+        self.assertTrue(cache.fetch(keys[2], fetched))
+        self.assertEqual(sorted(os.listdir(fetched)), ['faces', 'points'])
+        with open(os.path.join(fetched, 'points')) as f:
+            self.assertEqual(f.read(), 'c'*50)
+
+    def test_evict_unused(self):
+        cache = CfdTools.MeshCache(os.path.join(self.temp_dir, 'cache'), max_age=3600)
+        keys = [cache.key('mesh', i) for i in range(2)]
+        cache.store(keys[0], self.makeMesh('a', 'a'))
+        last_used = time.time() - 7200
+        os.utime(os.path.join(cache.cache_dir, keys[0]), (last_used, last_used))
+        cache.store(keys[1], self.makeMesh('b', 'b'))
+        self.assertEqual(os.listdir(cache.cache_dir), [keys[1]])
+
+
+@unittest.skipIf(platform.system() == 'Windows', "Allrun only links the mesh on POSIX systems")
+class PolyMeshUpdateTest(unittest.TestCase):
+    """ Tests of writing a new mesh over a case which has been run, whose polyMesh links into polyMesh.org """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.case = os.path.join(self.temp_dir, 'case')
+        self.mesh_dir = os.path.join(self.case, 'constant', 'polyMesh')
+        self.source_dir = self.makeMesh(os.path.join(self.temp_dir, 'source'), 'new')
+        # As left by Allrun
+        self.makeMesh(os.path.join(self.case, 'constant', 'polyMesh.org'), 'old')
+        os.makedirs(self.mesh_dir)
+        for f in ['points', 'faces']:
+            os.symlink(os.path.join('..', 'polyMesh.org', f), os.path.join(self.mesh_dir, f))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def makeMesh(self, mesh_dir, contents):
+        os.makedirs(mesh_dir)
+        for f in ['points', 'faces']:
+            with open(os.path.join(mesh_dir, f), 'w') as fid:
+                fid.write(contents)
+        return mesh_dir
+
+    def checkMeshMoved(self):
+        CfdTools.movePolyMesh(self.case)
+        self.assertFalse(os.path.lexists(self.mesh_dir))
+        mesh_org = os.path.join(self.case, 'constant', 'polyMesh.org')
+        for f in ['points', 'faces']:
+            self.assertFalse(os.path.islink(os.path.join(mesh_org, f)))
+            with open(os.path.join(mesh_org, f)) as fid:
+                self.assertEqual(fid.read(), 'new')
+
+    def test_transfer(self):
+        CfdTools.transferPolyMesh(self.source_dir, self.mesh_dir, mode="reflink")
+        self.checkMeshMoved()
+
+    def test_fetch_from_cache(self):
+        cache = CfdTools.MeshCache(os.path.join(self.temp_dir, 'cache'))
+        key = cache.key('mesh')
+        cache.store(key, self.source_dir)
+        self.assertTrue(cache.fetch(key, self.mesh_dir))
+        self.checkMeshMoved()
+
+    def test_conversion(self):
+        # The mesh conversion utilities write into a polyMesh directory cleared beforehand
+        CfdTools.removePolyMesh(self.mesh_dir)
+        self.makeMesh(self.mesh_dir, 'new')
+        self.checkMeshMoved()
+
+
+class FaceIndexTest(unittest.TestCase):
+    """ Test of finding faces of the same geometry through CfdTools.FaceIndex """
+    class Vertex:
+        def __init__(self, x, y, z):
+            self.X, self.Y, self.Z = x, y, z
+
+    class Face:
+        def __init__(self, centre, area, vertices):
+            self.CenterOfMass = centre
+            self.Area = area
+            self.Vertexes = [FaceIndexTest.Vertex(*v) for v in vertices]
+
+        def shifted(self, dx):
+            """ Copy with all coordinates and the area offset by dx """
+            return FaceIndexTest.Face(tuple(c + dx for c in self.CenterOfMass), self.Area + dx,
+                                      [(v.X + dx, v.Y + dx, v.Z + dx) for v in self.Vertexes])
+
+    def test_matches_brute_force(self):
+        import random
+        rand = random.Random(0)
+        faces = []
+        for i in range(150):
+            vertices = [tuple(rand.uniform(-100, 100) for j in range(3)) for k in range(rand.choice([1, 3, 4]))]
+            centre = tuple(sum(v[j] for v in vertices)/len(vertices) for j in range(3))
+            faces.append(self.Face(centre, rand.uniform(0, 50), vertices))
+        # Faces on a grid line of the index (a multiple of 1e-6 times the largest value) and either side of it
+        line = 1234*1e-6*max(abs(c) for f in faces for c in f.CenterOfMass)
+        area = 1234*1e-6*max(f.Area for f in faces)
+        on_line = self.Face((line, line, line), area, [(line, line, line)]*3)
+        faces += [on_line, on_line.shifted(-5e-13), on_line.shifted(5e-13)]
+        faces += [faces[0], faces[1].shifted(1e-13)]  # Duplicates within the tolerance
+
+        index = CfdTools.FaceIndex(faces)
+        queries = [f.shifted(dx) for f in faces for dx in [0, 4e-13, -4e-13, 1e-9]]
+        for query in queries:
+            expected = [i for i, f in enumerate(faces) if CfdTools.isSameGeometry(query, f)]
+            self.assertEqual(index.find(query), expected)
+        # Each face finds at least itself, and near the grid line the neighbours within the tolerance
+        self.assertEqual(index.find(faces[0]), [0, 153])
+        self.assertEqual(index.find(on_line), [150, 151, 152])
+        self.assertEqual(index.find(on_line.shifted(1e-9)), [])
+
+
+class UnvBoundaryTest(unittest.TestCase):
+    """ Test of the UNV boundary group records against the original line by line formatting """
+    class Element:
+        def __init__(self, shape_type, faces):
+            self.ShapeType = shape_type
+            self.faces = faces
+
+    class Part:
+        def __init__(self, elements):
+            self.Shape = self
+            self.elements = elements
+
+        def getElement(self, name):
+            return self.elements[name]
+
+    class FemMesh:
+        def __init__(self):
+            self.FemMesh = self
+            self.calls = 0
+
+        def getFacesByFace(self, elem):
+            self.calls += 1
+            return elem.faces
+
+    class BoundaryCondition:
+        def __init__(self, label, part, references):
+            self.Label = label
+            self.Document = self
+            self.part = part
+            self.References = references
+
+        def getObject(self, name):
+            return self.part
+
+    @staticmethod
+    def oldRecord(mesh_obj, bc_id, bc_object):
+        """ Formatting of dataset 2467 groups before they were written in bulk """
+        facet_list = []
+        for o, e in bc_object.References:
+            elem = bc_object.Document.getObject(o).Shape.getElement(e)
+            if elem.ShapeType == 'Face':
+                facet_list.extend(i for i in mesh_obj.FemMesh.getFacesByFace(elem))
+        nr_facets = len(facet_list)
+        lines = ["{:>10d}         0         0         0         0         0         0{:>10d}\n".format(
+            bc_id, nr_facets), bc_object.Label + "\n"]
+        for i in range(int(nr_facets / 2)):
+            lines.append("         8{:>10d}         0         0         ".format(facet_list[2 * i]))
+            lines.append("         8{:>10d}         0         0         \n".format(facet_list[2 * i + 1]))
+        if nr_facets % 2:
+            lines.append("         8{:>10d}         0         0         \n".format(facet_list[-1]))
+        return ''.join(lines)
+
+    def test_records_match_line_format(self):
+        part = self.Part({'Face1': self.Element('Face', [1, 22, 333]),
+                          'Face2': self.Element('Face', [4444, 55555, 666666, 7777777, 88888888]),
+                          'Face3': self.Element('Face', []),
+                          'Edge1': self.Element('Edge', [9])})
+        groups = [[('Part', 'Face1')],  # Odd count
+                  [('Part', 'Face1'), ('Part', 'Face2')],  # Even count, Face1 from the cache
+                  [('Part', 'Face2'), ('Part', 'Edge1')],  # Odd count, edge ignored
+                  [('Part', 'Face3')],  # Empty
+                  []]
+        mesh_obj = self.FemMesh()
+        face_cache = {}
+        for bc_id, references in enumerate(groups, 1):
+            bc_obj = self.BoundaryCondition('boundary{}'.format(bc_id), part, references)
+            record, nr_facets = CfdTools._unv_bc_faces(mesh_obj, bc_id, bc_obj, face_cache)
+            self.assertEqual(record, self.oldRecord(self.FemMesh(), bc_id, bc_obj))
+            self.assertEqual(nr_facets, sum(len(part.getElement(e).faces) for o, e in references
+                                            if e.startswith('Face')))
+        # Each referenced face is only looked up once
+        self.assertEqual(mesh_obj.calls, 3)
+
+
+class PolyMeshWriterTest(unittest.TestCase):
+    """ Tests of writing a polyMesh directly from mesh arrays """
+    def setUp(self):
+        self.mesh_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.mesh_dir)
+
+    def test_two_hex_cells(self):
+        import numpy
+        # Two unit cubes side by side in x, in SMDS node ordering
+        points = numpy.array([(x, y, z) for z in (0, 1) for y in (0, 1) for x in (0, 1, 2)], dtype=float)
+        cells = {8: numpy.array([[0, 1, 4, 3, 6, 7, 10, 9], [1, 2, 5, 4, 7, 8, 11, 10]])}
+        inlet = numpy.array([[0, 3, 9, 6]])
+        outlet = numpy.array([[2, 5, 11, 8]])
+        polymesh = CfdTools.buildPolyMesh(points, cells, [inlet, outlet], [('inlet', 'patch'), ('outlet', 'wall')])
+        self.assertEqual(polymesh['owner'][0], 0)
+        self.assertEqual(list(polymesh['neighbour']), [1])
+        self.assertEqual(polymesh['boundary'], [('inlet', 'patch', 1, 1), ('outlet', 'wall', 1, 2),
+                                                ('defaultFaces', 'wall', 8, 3)])
+        # Every face points out of its owner cell
+        centres = points[cells[8]].mean(axis=1)
+        for face, owner in zip(polymesh['faces'], polymesh['owner']):
+            p = points[face]
+            normal = numpy.cross(p[2] - p[0], p[3] - p[1])
+            self.assertGreater(numpy.dot(normal, p.mean(axis=0) - centres[owner]), 0)
+
+        for binary in [False, True]:
+            CfdTools.writePolyMesh(self.mesh_dir, polymesh, points*0.001, binary)
+            self.assertEqual(sorted(os.listdir(self.mesh_dir)), ['boundary', 'faces', 'neighbour', 'owner', 'points'])
+        with open(os.path.join(self.mesh_dir, 'owner'), 'rb') as f:
+            self.assertIn(b'note        "nPoints:12 nCells:2 nFaces:11 nInternalFaces:1";', f.read())
+
+
+class STLWriterTest(unittest.TestCase):
+    """ Tests of writing surface triangles to STL """
+    def setUp(self):
+        self.stl_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.stl_dir)
+
+    def test_ascii_and_binary(self):
+        import numpy
+        triangles = numpy.array([[(0, 0, 0), (1000, 0, 0), (0, 1000, 0)], [(0, 0, 0), (0, 1000, 0), (0, 0, 1000)]],
+                                dtype=float)
+        solids = [('face0', triangles[:1]), ('face1', triangles[1:])]
+
+        file_name = os.path.join(self.stl_dir, 'ascii.stl')
+        CfdTools.writeSTL(file_name, solids, 0.001)
+        with open(file_name) as f:
+            lines = [l.split() for l in f]
+        self.assertEqual([l[1] for l in lines if l[0] in ('solid', 'endsolid')], ['face0', 'face0', 'face1', 'face1'])
+        self.assertEqual(lines[1], ['facet', 'normal', '0', '0', '1'])
+        self.assertEqual([l[1:] for l in lines if l[0] == 'vertex'][1], ['1', '0', '0'])
+
+        file_name = os.path.join(self.stl_dir, 'binary.stl')
+        CfdTools.writeSTL(file_name, solids, 0.001, binary=True)
+        with open(file_name, 'rb') as f:
+            data = f.read()
+        self.assertEqual(len(data), 84 + 2*50)
+        self.assertFalse(data.startswith(b'solid'))
+        facets = numpy.frombuffer(data[84:], dtype=numpy.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)),
+                                                                ('attribute', '<u2')]))
+        numpy.testing.assert_allclose(facets['vertices'], triangles*0.001)
+        numpy.testing.assert_allclose(facets['normal'], [(0, 0, 1), (1, 0, 0)])
+        self.assertEqual(list(facets['attribute']), [0, 1])
+
+
+class DeferredImportTest(unittest.TestCase):
+    """ Test that importing workbench modules, and activating the workbench in the GUI, does not load heavy
+    dependencies which are only needed once a command runs. Each check runs in a fresh FreeCAD process and inspects
+    sys.modules, so that it does not depend on what this process has already imported. """
+    # Module to import: modules it must not load
+    DEFERRED = [('TemplateBuilder', ['multiprocessing.pool']),
+                ('CfdTools', ['Fem', 'Gnuplot', 'multiprocessing.pool']),
+                ('CfdRunnableFoam', ['Gnuplot'])] + \
+               [(m, ['FemGui']) for m in ['_CommandCfdAnalysis', '_CommandCfdSolverFoam', '_CommandCfdSolverControl',
+                                          '_CommandCfdPhysicsSelection', '_CommandCfdInitialiseInternalFlowField',
+                                          '_CommandCfdFluidBoundary', '_CommandCfdPorousZone',
+                                          '_CommandCfdInitialisationZone', '_CommandCfdFluidMaterial',
+                                          '_CommandCfdMeshGmshFromShape', '_CommandCfdMeshRegion',
+                                          '_CommandCfdMeshCartFromShape']]
+    # Modules which activating the workbench in the GUI must not load, and the prefix of the task panel modules.
+    # FemGui is not among them since the FEM CommandManager, on which the commands are based, loads it in the GUI.
+    GUI_DEFERRED = ['Gnuplot', 'multiprocessing.pool', 'CfdRunnableFoam']
+    TASK_PANEL_PREFIX = '_TaskPanel'
+
+    def loadedModules(self, executable, args, steps):
+        """ Run the steps, a list of (name, python statement), in a fresh FreeCAD process. Returns, for each step,
+        the names of the modules loaded once it has run. """
+        freecad_exe = os.path.join(FreeCAD.getHomePath(), 'bin', executable)
+        if platform.system() == 'Windows':
+            freecad_exe += '.exe'
+        if not os.path.exists(freecad_exe):
+            self.skipTest("{} not found".format(executable))
+        temp_dir = tempfile.mkdtemp()
+        try:
+            results_file = os.path.join(temp_dir, 'modules.json')
+            script_file = os.path.join(temp_dir, 'modules.py')
+            script = ["import sys, os, json", "results = []"]
+            for name, statement in steps:
+                script += [statement, "results.append([{!r}, [m for m, module in sys.modules.items() "
+                                      "if module is not None]])".format(name)]
+            script += ["with open({!r}, 'w') as f:".format(results_file),
+                       "    json.dump(results, f)",
+                       "os._exit(0)"]
+            with open(script_file, 'w') as f:
+                f.write('\n'.join(script) + '\n')
+            subprocess.check_output([freecad_exe] + args + [script_file], stderr=subprocess.STDOUT)
+            with open(results_file) as f:
+                return json.load(f)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_console_imports(self):
+        steps = [(name, "import {}".format(name)) for name, deferred in self.DEFERRED]
+        for (name, loaded), (module, deferred) in zip(self.loadedModules('FreeCADCmd', [], steps), self.DEFERRED):
+            for d in deferred:
+                self.assertFalse(d in loaded, "Importing {} loads {}".format(name, d))
+
+    def test_gui_activation(self):
+        if platform.system() == 'Linux' and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+            self.skipTest("No display for the FreeCAD GUI")
+        steps = [('CfdOFWorkbench', "import FreeCADGui; FreeCADGui.activateWorkbench('CfdOFWorkbench')")]
+        name, loaded = self.loadedModules('FreeCAD', [], steps)[0]
+        self.assertTrue('_CommandCfdSolverControl' in loaded, "Workbench not activated")
+        for d in self.GUI_DEFERRED:
+            self.assertFalse(d in loaded, "Activating the workbench loads {}".format(d))
+        self.assertEqual([m for m in loaded if m.startswith(self.TASK_PANEL_PREFIX)], [])
+
+
 def compareInpFiles(file_name1, file_name2):
     file1 = open(file_name1, 'r')
     f1 = file1.readlines()
@@ -97,6 +97,20 @@ class _CfdMeshCart():
         obj.Algorithm3D = _CfdMeshCart.known_mesh_algorithm_3D
         obj.Algorithm3D = 'Cartesian'
 
+        self.addFaceMappingProperty(obj)
+
+    @staticmethod
+    def addFaceMappingProperty(obj):
+        # Output status (8): updating the cache does not mark the mesh as needing recompute
+        obj.addProperty("App::PropertyPythonObject", "FaceMapping", "Base",
+                        "Cached mapping of boundary references to shape faces", 8)
+        obj.setEditorMode("FaceMapping", 2)
+        obj.FaceMapping = {}
+
+    def onDocumentRestored(self, obj):
+        if not hasattr(obj, "FaceMapping"):
+            self.addFaceMappingProperty(obj)
+
     def execute(self, obj):
         return
 
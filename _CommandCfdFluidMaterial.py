@@ -35,7 +35,6 @@ import os
 if FreeCAD.GuiUp:
     import FreeCADGui
     from PySide import QtCore
-    import FemGui
 
 
 class setCfdFluidPropertyCommand(CommandManager):
@@ -32,7 +32,6 @@ try:
     from femcommands.manager import CommandManager
 except ImportError:  # Backward compatibility
     from PyGui.FemCommands import FemCommands as CommandManager
-import FemGui
 import CfdTools
 import os
 
@@ -63,4 +62,5 @@ class _CommandCfdInitialisationZone(CommandManager):
         FreeCADGui.ActiveDocument.setEdit(FreeCAD.ActiveDocument.ActiveObject.Name)
 
 
-FreeCADGui.addCommand('Cfd_InitialisationZone', _CommandCfdInitialisationZone())
+if FreeCAD.GuiUp:
+    FreeCADGui.addCommand('Cfd_InitialisationZone', _CommandCfdInitialisationZone())
@@ -33,7 +33,6 @@ try:
     from femcommands.manager import CommandManager
 except ImportError:  # Backward compatibility
     from PyGui.FemCommands import FemCommands as CommandManager
-import FemGui
 import CfdTools
 import os
 
@@ -57,6 +56,7 @@ class _CommandCfdInitialiseInternalFlowField(CommandManager):
 
     def Activated(self):
         FreeCAD.ActiveDocument.openTransaction("Initialise the internal flow variables")
+        import FemGui
         isPresent = False
         members = FemGui.getActiveAnalysis().Group
         for i in members:
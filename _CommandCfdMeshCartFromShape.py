@@ -31,7 +31,6 @@ try:
 except ImportError:  # Backward compatibility
     from PyGui.FemCommands import FemCommands as CommandManager
 import FreeCADGui
-import FemGui
 from PySide import QtCore
 import CfdTools
 import os
@@ -51,6 +50,7 @@ class _CommandCfdMeshCartFromShape(CommandManager):
 
     def Activated(self):
         FreeCAD.ActiveDocument.openTransaction("Create cut-cell Cartesian mesh")
+        import FemGui
         FreeCADGui.addModule("FemGui")
         analysis_obj = FemGui.getActiveAnalysis()
         if analysis_obj:
@@ -73,4 +73,5 @@ class _CommandCfdMeshCartFromShape(CommandManager):
             print "ERROR: You cannot have more than one mesh object"
         FreeCADGui.Selection.clearSelection()
 
-FreeCADGui.addCommand('Cfd_MeshCartFromShape', _CommandCfdMeshCartFromShape())
+if FreeCAD.GuiUp:
+    FreeCADGui.addCommand('Cfd_MeshCartFromShape', _CommandCfdMeshCartFromShape())
@@ -30,7 +30,6 @@ try:
 except ImportError:  # Backward compatibility
     from PyGui.FemCommands import FemCommands as CommandManager
 import FreeCADGui
-import FemGui
 from PySide import QtCore
 import CfdTools
 import os
@@ -50,6 +49,7 @@ class _CommandCfdMeshGmshFromShape(CommandManager):
 
     def Activated(self):
         FreeCAD.ActiveDocument.openTransaction("Create CFD mesh by GMSH")
+        import FemGui
         FreeCADGui.addModule("FemGui")
         analysis_obj = FemGui.getActiveAnalysis()
         if analysis_obj:
@@ -73,4 +73,5 @@ class _CommandCfdMeshGmshFromShape(CommandManager):
         FreeCADGui.Selection.clearSelection()
 
 
-FreeCADGui.addCommand('Cfd_MeshGmshFromShape', _CommandCfdMeshGmshFromShape())
+if FreeCAD.GuiUp:
+    FreeCADGui.addCommand('Cfd_MeshGmshFromShape', _CommandCfdMeshGmshFromShape())
@@ -64,4 +64,5 @@ class _CommandMeshRegion(CommandManager):
 
         FreeCADGui.Selection.clearSelection()
 
-FreeCADGui.addCommand('Fem_MeshRegion', _CommandMeshRegion())
+if FreeCAD.GuiUp:
+    FreeCADGui.addCommand('Fem_MeshRegion', _CommandMeshRegion())
@@ -9,7 +9,6 @@ try:
     from femcommands.manager import CommandManager
 except ImportError:  # Backward compatibility
     from PyGui.FemCommands import FemCommands as CommandManager
-import FemGui
 import CfdTools
 import os
 
@@ -31,6 +30,7 @@ class _CommandCfdPhysicsSelection(CommandManager):
 
     def Activated(self):
         FreeCAD.ActiveDocument.openTransaction("Choose appropriate physics model")
+        import FemGui
         isPresent = False
         members = FemGui.getActiveAnalysis().Group
         for i in members:
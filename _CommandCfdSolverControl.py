@@ -35,7 +35,6 @@ import os
 
 if FreeCAD.GuiUp:
     import FreeCADGui
-    import FemGui
     from PySide import QtCore
 
 
@@ -55,6 +54,7 @@ class _CommandCfdSolverControl(CommandManager):
 
         CfdTools.hide_parts_show_meshes()
 
+        import FemGui
         isPresent = False
         members = FemGui.getActiveAnalysis().Group
         for i in members:
@@ -163,6 +163,7 @@ class _TaskPanelCfdSolverControl:
 
     def writerFinished(self, success):
         if success:
+            self.solver_runner.writer.storeFaceMapping()
             self.consoleMessage("Write {} case is completed".format(self.solver_object.SolverName))
             self.form.pb_edit_inp.setEnabled(True)
             self.form.pb_run_solver.setEnabled(True)